@@ -9,7 +9,7 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='tastypiex',
     version='0.8',
-    packages=['tastypiex'],
+    packages=['tastypiex', 'tastypiex.management', 'tastypiex.management.commands'],
     include_package_data=True,
     license='MIT',  # example license
     description='tastypie extensions',
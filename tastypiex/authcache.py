@@ -0,0 +1,102 @@
+"""
+Request-scoped caching of authorization decisions
+
+Within one request tastypie calls the same authorization method many
+times, e.g. read_detail once per bundle and once per related resource.
+Decorate an Authorization's methods with cached_decision to compute
+each decision once per request:
+
+    class SomeAuthorization(Authorization):
+        @cached_decision('detail')
+        def read_detail(self, object_list, bundle):
+            ...
+
+        @cached_decision('list')
+        def read_list(self, object_list, bundle):
+            ...
+
+Decisions are keyed by (authorization, action, scope, object pk) and
+kept on the request, i.e. they are dropped along with the request at
+the end of the response.
+
+What is cached:
+    - detail: the result or the Unauthorized exception of read_detail,
+      per object pk. Objects that have no pk yet (e.g. on create) are never
+      cached. create, update and delete decisions depend on the hydrated
+      state of the object and are always recomputed.
+    - list: only results that return the object list unchanged, per
+      model, i.e. decisions that do not depend on the object list's
+      content. Filtered lists depend on the object list and are always
+      recomputed. A method whose decision depends on the content (e.g.
+      whether the list is empty) must return a copy of the object list.
+
+Set cache_decisions = False on the Authorization instance or class to
+disable caching.
+"""
+import functools
+
+from tastypie.exceptions import Unauthorized
+
+_PASS = object()
+
+
+def request_decisions(request):
+    """ return the decision cache of a request, created on first use """
+    return vars(request).setdefault('_tastypiex_decisions', {})
+
+
+def decision_key(authorization, action, scope, object_list, bundle):
+    """ return the cache key for a decision, or None if it cannot be cached """
+    if scope == 'detail':
+        if action != 'read':
+            return None
+        pk = getattr(bundle.obj, 'pk', None)
+        if pk is None:
+            return None
+        return authorization, action, scope, type(bundle.obj), pk
+    model = getattr(object_list, 'model', type(object_list))
+    return authorization, action, scope, model, None
+
+
+def cached_decision(scope):
+    """
+    cache the decision of an Authorization method(object_list, bundle) per request
+
+    Args:
+        scope (str): 'list' or 'detail'
+    """
+
+    def decorator(meth):
+        action = meth.__name__.split('_')[0]
+
+        @functools.wraps(meth)
+        def inner(self, object_list, bundle):
+            request = getattr(bundle, 'request', None)
+            if request is None or not getattr(self, 'cache_decisions', True):
+                return meth(self, object_list, bundle)
+            key = decision_key(self, action, scope, object_list, bundle)
+            if key is None:
+                return meth(self, object_list, bundle)
+            decisions = request_decisions(request)
+            if key in decisions:
+                decision = decisions[key]
+                if decision is _PASS:
+                    return object_list
+                if isinstance(decision, Unauthorized):
+                    raise decision
+                return decision
+            try:
+                result = meth(self, object_list, bundle)
+            except Unauthorized as e:
+                if scope == 'detail':
+                    decisions[key] = e
+                raise
+            if result is object_list:
+                decisions[key] = _PASS
+            elif scope == 'detail':
+                decisions[key] = result
+            return result
+
+        return inner
+
+    return decorator
@@ -3,6 +3,7 @@ from django.urls import re_path as url, include
 from django.shortcuts import render
 from docutils.core import publish_parts
 
+from tastypiex.metrics import metrics_view
 from tastypiex.modresource import add_resource_mixins, \
     override_resource_meta
 from tastypiex.util import load_api
@@ -111,17 +112,21 @@ class ApiCentralizer(object):
         # load swagger ui URLs on a different path
         urlpatterns += patterns('', *ApiCentralizer(path=r'api/', swaggerui=False).urls)
         urlpatterns += patterns('', *ApiCentralizer(swaggerui=False).get_swagger_urls(path))
+
+        # add the metrics endpoint at path/metrics/, see tastypiex.metrics
+        urlpatterns += patterns('', *ApiCentralizer(path=r'api/', metrics=True).urls)
     """
 
     def __init__(self, config=None, apis=None, mixins=None, meta=None,
                  path=None, swaggerui=True, autoinit=True,
-                 docstyle='markdown', redocui=True):
+                 docstyle='markdown', redocui=True, metrics=False):
         self.config = config or []
         self.apis = apis or self.get_apis(self.config)
         self.path = path or r'^api/'
         self.swaggerui = swaggerui or 'tastypie_swagger' in settings.INSTALLED_APPS
         self.redocui = redocui
         self.docstyle = docstyle
+        self.metrics = metrics
         if autoinit:
             self.centralize(self.apis, mixins=mixins, meta=meta)
 
@@ -215,8 +220,15 @@ class ApiCentralizer(object):
             # docpath = (r'%s/doc/redoc/' % self.path).replace('//', '/')
             urls.extend(self.get_api_urls(docpath, kind='redoc'))
             urls.append(url(docpath + '$', self.get_docview(RedocIndexView)))
+        if self.metrics:
+            urls.append(self.get_metrics_url(self.path))
         return urls
 
+    def get_metrics_url(self, path):
+        """ return the url of the metrics endpoint, at path/metrics/ """
+        metricspath = (r'%s/metrics/' % path).replace('//', '/')
+        return url(metricspath + '$', metrics_view, name='tastypiex_metrics')
+
     def _gen_api_urls(self, apis, path, kind):
         if '{api_name}' not in path:
             path = (r'%s/{api_name}/{kind}/' % path).replace('//', '/')
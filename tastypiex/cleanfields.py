@@ -2,6 +2,51 @@
 """
 
 
+class FieldPlan(object):
+    """
+    the keys to keep in a bundle's data, compiled from a Resource's Meta
+
+    Either allowed is a frozenset of the keys to keep, or allowed is None
+    and removed is a frozenset of the keys to drop.
+    """
+
+    def __init__(self, fields=None, excludes=None, exclude_uri=False):
+        removed = set(excludes or [])
+        if exclude_uri:
+            removed.add('resource_uri')
+        if fields:
+            self.allowed = frozenset((set(fields) | {'resource_uri'}) - removed)
+        else:
+            self.allowed = None
+        self.removed = frozenset(removed)
+
+    @classmethod
+    def from_meta(cls, meta):
+        return cls(fields=meta.fields, excludes=meta.excludes,
+                   exclude_uri=getattr(meta, 'exclude_uri', False))
+
+    def restrict(self, names):
+        """ return a new plan that only keeps names (and resource_uri), as far as allowed """
+        names = set(names) | {'resource_uri'}
+        fields = names & self.allowed if self.allowed is not None else names
+        return FieldPlan(fields=fields or ['resource_uri'], excludes=self.removed)
+
+    def keeps(self, key):
+        if self.allowed is not None:
+            return key in self.allowed
+        return key not in self.removed
+
+    def apply(self, data):
+        """ return a new dict of data with only the planned keys """
+        if self.allowed is not None:
+            allowed = self.allowed
+            return {k: v for k, v in data.items() if k in allowed}
+        if self.removed:
+            removed = self.removed
+            return {k: v for k, v in data.items() if k not in removed}
+        return data
+
+
 class CleanBundleFieldsMixin(object):
     """
     Tastypie: remove any resource fields in a Resource's Meta
@@ -14,16 +59,153 @@ class CleanBundleFieldsMixin(object):
     adds this capability
 
     The 'resource_uri' is never excluded, unless you set Meta.exclude_uri=True
+
+    The allowed keys are compiled once into a FieldPlan and applied in
+    one pass per bundle, for detail and list responses. If Meta is changed
+    at runtime, call meta_changed() to rebuild the plan (this is done by
+    ApiCentralizer/override_resource_meta).
+
+    Fields that are not in the plan are never dehydrated, i.e. their
+    dehydrate() and dehydrate_<field>() methods are not called. Note
+    that this means Resource.dehydrate() does not see excluded fields in
+    bundle.data.
+
+    For ModelResources the model columns of excluded fields can also be
+    deferred in get_object_list(), so they are not queried. Enable this
+    only if no dehydrate() or dehydrate_<field>() method reads an excluded
+    column, else every object queries it again:
+
+        class Meta:
+            defer_excluded = True
+
+    The column of Meta.detail_uri_name is never deferred.
+
+    Sparse fieldsets:
+
+        Clients can select the fields to return by ?fields=a,b,c. Only the
+        selected fields (out of those allowed by Meta) are dehydrated and
+        serialized. With Meta.defer_excluded, the model columns of all other
+        fields are deferred. Related fields are only followed if selected. The selection applies
+        to the requested resource, not to related resources. To change the
+        name of the query parameter, or to disable sparse fieldsets, set
+
+            class Meta:
+                sparse_fields_param = 'only' # or None to disable
     """
+    _field_plan = None
+    _planned_fields = None
 
-    def alter_detail_data_to_serialize(self, request, bundle):
+    @property
+    def field_plan(self):
+        if self._field_plan is None:
+            self._field_plan = FieldPlan.from_meta(self._meta)
+        return self._field_plan
+
+    @property
+    def planned_fields(self):
+        """ the resource fields to dehydrate, as a dict of name => field """
+        if self._planned_fields is None:
+            plan = self.field_plan
+            self._planned_fields = {name: field for name, field in self.fields.items()
+                                    if plan.keeps(name)}
+        return self._planned_fields
+
+    def deferred_columns(self, fields):
+        """ return the model columns of excluded fields, unless used by any of fields
+
+        Excluded fields are the resource fields not in fields, and any model
+        fields listed in Meta.excludes. Returns () unless Meta.defer_excluded
+        is set.
+        """
+        model = getattr(self._meta, 'object_class', None)
+        if not getattr(self._meta, 'defer_excluded', False) or model is None or not hasattr(model, '_meta'):
+            return ()
+        columns = {f.name for f in model._meta.concrete_fields if not f.primary_key}
+        used = {field.attribute for field in fields.values()}
+        # the detail uri is built for every object
+        used.add(self._meta.detail_uri_name)
+        excluded = {field.attribute for name, field in self.fields.items() if name not in fields}
+        excluded.update(self._meta.excludes or [])
+        return tuple(sorted(attribute for attribute in excluded
+                            if isinstance(attribute, str) and attribute in columns
+                            and attribute not in used))
+
+    def requested_fields(self, request):
+        """ return the field names selected by ?fields=a,b,c, or None """
+        param = getattr(self._meta, 'sparse_fields_param', 'fields')
+        value = request.GET.get(param) if param and hasattr(request, 'GET') else None
+        if not value or not isinstance(value, str):
+            return None
+        # only apply to the requested resource, not to related resources
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.kwargs.get('resource_name', self._meta.resource_name) != self._meta.resource_name:
+            return None
+        return frozenset(name.strip() for name in value.split(',') if name.strip())
+
+    def request_plan(self, request):
+        """ return the field plan and the fields to dehydrate for a request """
+        requested = self.requested_fields(request)
+        if requested is None:
+            return self.field_plan, self.planned_fields
+        plans = vars(request).setdefault('_tastypiex_field_plans', {})
+        key = (id(self), requested)
+        if key not in plans:
+            plan = self.field_plan.restrict(requested)
+            plans[key] = plan, {name: field for name, field in self.fields.items() if plan.keeps(name)}
+        return plans[key]
+
+    def get_object_list(self, request):
+        object_list = super(CleanBundleFieldsMixin, self).get_object_list(request)
+        plan, fields = self.request_plan(request)
+        deferred = self.deferred_columns(fields)
+        if deferred and hasattr(object_list, 'defer'):
+            object_list = object_list.defer(*deferred)
+        return object_list
+
+    def full_dehydrate(self, bundle, for_list=False):
+        # adopted from tastypie.Resource.full_dehydrate, only dehydrates planned fields
         data = bundle.data
-        if len(self._meta.fields or []):
-            for k in [k for k in data.keys() if k not in self._meta.fields]:
-                if k != 'resource_uri':
-                    del data[k]
-        for k in [k for k in data.keys() if k in self._meta.excludes]:
-            del data[k]
-        if getattr(self._meta, 'exclude_uri', False):
-            del data['resource_uri']
+        api_name = self._meta.api_name
+        resource_name = self._meta.resource_name
+        plan, fields = self.request_plan(bundle.request)
+        for field_name, field_object in fields.items():
+            # If it's not for use in this mode, skip
+            field_use_in = field_object.use_in
+            if callable(field_use_in):
+                if not field_use_in(bundle):
+                    continue
+            elif field_use_in not in ['all', 'list' if for_list else 'detail']:
+                continue
+            # A touch leaky but it makes URI resolution work.
+            if field_object.dehydrated_type == 'related':
+                field_object.api_name = api_name
+                field_object.resource_name = resource_name
+            data[field_name] = field_object.dehydrate(bundle, for_list=for_list)
+            # Check for an optional method to do further dehydration.
+            method = getattr(self, "dehydrate_%s" % field_name, None)
+            if method:
+                data[field_name] = method(bundle)
+        bundle = self.dehydrate(bundle)
+        return bundle
+
+    def meta_changed(self):
+        self._field_plan = None
+        self._planned_fields = None
+        meta_changed = getattr(super(CleanBundleFieldsMixin, self), 'meta_changed', None)
+        if meta_changed is not None:
+            meta_changed()
+
+    def alter_detail_data_to_serialize(self, request, bundle):
+        plan, fields = self.request_plan(request)
+        data = bundle.data = plan.apply(bundle.data)
+        return data
+
+    def alter_list_data_to_serialize(self, request, data):
+        data = super(CleanBundleFieldsMixin, self).alter_list_data_to_serialize(request, data)
+        if not isinstance(data, dict):
+            return data
+        plan, fields = self.request_plan(request)
+        apply = plan.apply
+        for bundle in data.get(self._meta.collection_name) or []:
+            bundle.data = apply(bundle.data)
         return data
@@ -21,9 +21,15 @@ Authors:
 @author: patrick
 '''
 import logging
+import re
+import threading
 import warnings
+from types import MappingProxyType
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
 from django.views.decorators.csrf import csrf_exempt
 from tastypie import http
 from tastypie.exceptions import ImmediateHttpResponse
@@ -32,9 +38,138 @@ from tastypie.resources import Resource, ModelResource
 logger = logging.getLogger(__name__)
 
 
+class CORSPolicy(object):
+    """
+    CORS policy, i.e. the origins and headers to allow
+
+    Args:
+        origins (str|list): '*' to allow any origin (default), or a list of
+           origins. An origin may contain wildcards, e.g. 'https://*.example.com'
+        allow_headers (list): the request headers to allow
+        allow_methods (list): the methods to allow in preflight responses
+        expose_headers (list): the response headers to expose
+        max_age (int): seconds browsers may cache a preflight response
+        allow_credentials (bool): if True, send Access-Control-Allow-Credentials,
+           requires a list of origins
+
+    Headers are computed once per (origin, response kind, allowed methods)
+    and kept as immutable dicts. Unless all origins are allowed, the
+    requesting origin is echoed in Access-Control-Allow-Origin, and
+    responses vary by Origin.
+
+    Usage:
+        class MyResource(CORSResource):
+            class Meta:
+                cors_policy = CORSPolicy(origins=['https://app.example.com',
+                                                  'https://*.example.com'])
+
+        # or for all CORS resources, as kwargs to CORSPolicy
+        TASTYPIE_CORS_POLICY = dict(origins=['https://app.example.com'])
+    """
+    default_allow_headers = ('Content-Type', 'Authorization')
+    default_allow_methods = ('GET', 'PUT', 'POST', 'PATCH', 'DELETE')
+    default_expose_headers = ('Location',)
+    cache_size = 256
+
+    def __init__(self, origins='*', allow_headers=None, allow_methods=None,
+                 expose_headers=None, max_age=86400, allow_credentials=False):
+        origins = (origins,) if isinstance(origins, str) else tuple(origins or ())
+        self.any_origin = '*' in origins
+        if self.any_origin and allow_credentials:
+            # browsers refuse '*' with credentials, echoing any origin would defeat that
+            raise ImproperlyConfigured("CORSPolicy: allow_credentials requires a list of origins, not '*'")
+        self.origins = frozenset(origin for origin in origins if '*' not in origin)
+        patterns = [re.escape(origin).replace(r'\*', '[A-Za-z0-9.-]+')
+                    for origin in origins if '*' in origin and origin != '*']
+        self.origin_pattern = re.compile('|'.join(patterns)) if patterns else None
+        self.allow_headers = ', '.join(allow_headers or self.default_allow_headers)
+        self.allow_methods = ', '.join(method.upper() for method in
+                                       (allow_methods or self.default_allow_methods))
+        self.expose_headers = ', '.join(expose_headers or self.default_expose_headers)
+        self.max_age = max_age
+        self.allow_credentials = allow_credentials
+        self._headers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def vary(self):
+        """ True if the headers depend on the request's origin """
+        return not self.any_origin
+
+    def allowed_origin(self, origin):
+        """ return the value of Access-Control-Allow-Origin for origin, or None if not allowed """
+        if self.any_origin:
+            return '*'
+        if not origin:
+            return None
+        if origin in self.origins:
+            return origin
+        if self.origin_pattern is not None and self.origin_pattern.fullmatch(origin):
+            return origin
+        return None
+
+    def headers(self, origin=None, kind='response', allowed=None):
+        """ return the CORS headers as an immutable dict
+
+        Args:
+            origin (str): the request's Origin header
+            kind (str): 'response', 'expose' (response exposing headers)
+               or 'preflight'
+            allowed (tuple): the allowed methods, for preflight responses
+        """
+        allow_origin = self.allowed_origin(origin)
+        key = (allow_origin, kind, allowed)
+        try:
+            return self._headers[key]
+        except KeyError:
+            pass
+        headers = self.build_headers(allow_origin, kind, allowed)
+        with self._lock:
+            # origins are client controlled, don't let the cache grow unbounded
+            if len(self._headers) >= self.cache_size:
+                self._headers.clear()
+            self._headers[key] = headers
+        return headers
+
+    def build_headers(self, allow_origin, kind, allowed):
+        headers = {}
+        if allow_origin is not None:
+            headers['Access-Control-Allow-Origin'] = allow_origin
+            headers['Access-Control-Allow-Headers'] = self.allow_headers
+            if self.allow_credentials:
+                headers['Access-Control-Allow-Credentials'] = 'true'
+            if kind == 'expose':
+                headers['Access-Control-Expose-Headers'] = self.expose_headers
+            if kind == 'preflight':
+                headers['Access-Control-Allow-Methods'] = self.allow_methods
+                headers['Access-Control-Max-Age'] = str(self.max_age)
+        if kind == 'preflight':
+            headers['Allow'] = ','.join(method.upper() for method in allowed or ())
+        return MappingProxyType(headers)
+
+    def apply(self, response, origin=None, kind='response', allowed=None):
+        """ add the CORS headers for origin to response """
+        for header, value in self.headers(origin, kind, allowed).items():
+            response[header] = value
+        if self.vary:
+            patch_vary_headers(response, ('Origin',))
+        return response
+
+
 class CORSResourceMixin(object):
     """
     Class implementing CORS
+
+    The origins and headers to allow are specified by a CORSPolicy, from
+    Meta.cors_policy or settings.TASTYPIE_CORS_POLICY. By default any
+    origin is allowed.
+
+    OPTIONS (preflight) requests are answered directly by the view
+    returned from wrap_view, using headers precomputed per view. They
+    never reach authentication, throttling or the database. Browsers may
+    cache the preflight for Meta.cors_max_age or settings.TASTYPIE_CORS_MAX_AGE
+    seconds, defaults to 86400 (1 day). This applies unless Meta.cors_policy
+    is given, which then specifies max_age.
     """
 
     def __init__(self, *args, **kwargs):
@@ -43,28 +178,39 @@ class CORSResourceMixin(object):
             DeprecationWarning)
         return super(CORSResourceMixin, self).__init__(*args, **kwargs)
 
-    def error_response(self, *args, **kwargs):
+    @property
+    def cors_policy(self):
+        policy = self.__dict__.get('_cors_policy')
+        if policy is None:
+            policy = getattr(self._meta, 'cors_policy', None)
+            if policy is None:
+                kwargs = dict(getattr(settings, 'TASTYPIE_CORS_POLICY', None) or {})
+                max_age = getattr(self._meta, 'cors_max_age', getattr(settings, 'TASTYPIE_CORS_MAX_AGE', None))
+                if max_age is not None:
+                    kwargs['max_age'] = max_age
+                policy = CORSPolicy(**kwargs)
+            self.__dict__['_cors_policy'] = policy
+        return policy
+
+    def error_response(self, request, *args, **kwargs):
         response = super(CORSResourceMixin, self).error_response(
-            *args, **kwargs)
-        return self.add_cors_headers(response, expose_headers=True)
-
-    def add_cors_headers(self, response, expose_headers=False):
-        response['Access-Control-Allow-Origin'] = '*'
-        response[
-            'Access-Control-Allow-Headers'] = 'content-type, authorization'
-        if expose_headers:
-            response['Access-Control-Expose-Headers'] = 'Location'
-        return response
+            request, *args, **kwargs)
+        return self.add_cors_headers(response, expose_headers=True, request=request)
+
+    def add_cors_headers(self, response, expose_headers=False, request=None):
+        origin = request.META.get('HTTP_ORIGIN') if request is not None else None
+        return self.cors_policy.apply(response, origin=origin,
+                                      kind='expose' if expose_headers else 'response')
 
-    def create_response(self, *args, **kwargs):
+    def create_response(self, request, *args, **kwargs):
         """
         Create the response for a resource. Note this will only
         be called on a GET, POST, PUT request if
         always_return_data is True
         """
         response = super(CORSResourceMixin, self).create_response(
-            *args, **kwargs)
-        return self.add_cors_headers(response)
+            request, *args, **kwargs)
+        return self.add_cors_headers(response, request=request)
 
     def post_list(self, request, **kwargs):
         """
@@ -73,7 +219,7 @@ class CORSResourceMixin(object):
         """
         # logger.debug("post list %s\n%s" % (request, kwargs));
         response = super(CORSResourceMixin, self).post_list(request, **kwargs)
-        return self.add_cors_headers(response, True)
+        return self.add_cors_headers(response, True, request=request)
 
     def post_detail(self, request, **kwargs):
         """
@@ -82,7 +228,7 @@ class CORSResourceMixin(object):
         """
         # logger.debug("post detail %s\n%s" (request, **kwargs));
         response = super(CORSResourceMixin, self).post_list(request, **kwargs)
-        return self.add_cors_headers(response, True)
+        return self.add_cors_headers(response, True, request=request)
 
     def put_list(self, request, **kwargs):
         """
@@ -90,11 +236,11 @@ class CORSResourceMixin(object):
         regardless of returning data
         """
         response = super(CORSResourceMixin, self).put_list(request, **kwargs)
-        return self.add_cors_headers(response, True)
+        return self.add_cors_headers(response, True, request=request)
 
     def put_detail(self, request, **kwargs):
         response = super(CORSResourceMixin, self).put_detail(request, **kwargs)
-        return self.add_cors_headers(response, True)
+        return self.add_cors_headers(response, True, request=request)
 
     def patch_list(self, request, **kwargs):
         """
@@ -102,22 +248,22 @@ class CORSResourceMixin(object):
         regardless of returning data
         """
         response = super(CORSResourceMixin, self).patch_list(request, **kwargs)
-        return self.add_cors_headers(response, True)
+        return self.add_cors_headers(response, True, request=request)
 
     def patch_detail(self, request, **kwargs):
         response = super(CORSResourceMixin, self).patch_detail(
             request, **kwargs)
-        return self.add_cors_headers(response, True)
+        return self.add_cors_headers(response, True, request=request)
 
     def delete_detail(self, request, **kwargs):
         response = super(CORSResourceMixin, self).delete_detail(
             request, **kwargs)
-        return self.add_cors_headers(response, True)
+        return self.add_cors_headers(response, True, request=request)
 
     def delete_list(self, request, **kwargs):
         response = super(CORSResourceMixin, self).delete_list(
             request, **kwargs)
-        return self.add_cors_headers(response, True)
+        return self.add_cors_headers(response, True, request=request)
 
     def method_check(self, request, allowed=None):
         """
@@ -130,14 +276,7 @@ class CORSResourceMixin(object):
         allows = ','.join(map(lambda s: s.upper(), allowed))
 
         if request_method == 'options':
-            response = HttpResponse(allows)
-            response['Access-Control-Allow-Origin'] = '*'
-            response[
-                'Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
-            response[
-                'Access-Control-Allow-Methods'] = "GET, PUT, POST, PATCH, DELETE"
-            response['Allow'] = allows
-            raise ImmediateHttpResponse(response=response)
+            raise ImmediateHttpResponse(response=self.preflight_response(allowed, request=request))
 
         if request_method not in allowed:
             response = http.HttpMethodNotAllowed(allows)
@@ -146,13 +285,47 @@ class CORSResourceMixin(object):
 
         return request_method
 
+    def preflight_headers(self, allowed, origin=None):
+        """ return the headers of a preflight response, computed once per origin and allowed methods """
+        return self.cors_policy.headers(origin, 'preflight', tuple(allowed or ()))
+
+    def preflight_response(self, allowed, request=None):
+        origin = request.META.get('HTTP_ORIGIN') if request is not None else None
+        allowed = tuple(allowed or ())
+        response = HttpResponse(self.preflight_headers(allowed, origin)['Allow'])
+        return self.cors_policy.apply(response, origin=origin, kind='preflight', allowed=allowed)
+
+    def view_allowed_methods(self, view):
+        """ return the allowed methods of a view as used by wrap_view """
+        if view == 'dispatch_list':
+            return self._meta.list_allowed_methods
+        if view == 'dispatch_detail':
+            return self._meta.detail_allowed_methods
+        return getattr(getattr(self, view, None), 'allowed_methods', None) or self._meta.allowed_methods
+
+    def meta_changed(self):
+        self.__dict__.pop('_cors_policy', None)
+        meta_changed = getattr(super(CORSResourceMixin, self), 'meta_changed', None)
+        if meta_changed is not None:
+            meta_changed()
+
     def wrap_view(self, view):
+        # build tastypie's wrapper once per view at url construction,
+        # the per-request path only pops the format
+        wrapped_views = self.__dict__.setdefault('_cors_wrapped_views', {})
+        if view in wrapped_views:
+            return wrapped_views[view]
+        wrapped_view = super(CORSResourceMixin, self).wrap_view(view)
+
         @csrf_exempt
         def wrapper(request, *args, **kwargs):
+            if request.method == 'OPTIONS':
+                # preflight fast path
+                return self.preflight_response(self.view_allowed_methods(view), request=request)
             request.format = kwargs.pop('format', None)
-            wrapped_view = super(CORSResourceMixin, self).wrap_view(view)
             return wrapped_view(request, *args, **kwargs)
 
+        wrapped_views[view] = wrapper
         return wrapper
 
 
@@ -1,7 +1,250 @@
-from tastypie.exceptions import ImmediateHttpResponse, Unauthorized
-from tastypie.http import HttpUnauthorized
+import hashlib
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.http import HttpResponse
+from django.http.request import RawPostDataException
+from django.urls import NoReverseMatch
+from django.views.decorators.csrf import csrf_exempt
+
+from tastypie.authorization import Authorization
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse, Unauthorized, UnsupportedFormat
+from tastypie.http import (HttpAccepted, HttpBadRequest, HttpConflict, HttpNotFound, HttpUnauthorized,
+                           HttpUnprocessableEntity)
 from tastypie.utils import trailing_slash
 
+from tastypiex.metrics import QUERY_BUCKETS, count_queries, registry, timed
+from tastypiex.util import ExpiringLRUCache, load_class
+
+
+class CommandJob(object):
+    """ a command submitted by @cqrsapi(run_async=True)
+
+    The job's state is kept as a dict in the job store, see CommandJobs,
+    so that it can be shared between processes.
+    """
+
+    def __init__(self, command, owner, id=None, status='pending', result=None, error=None, created=None):
+        self.id = id or uuid.uuid4().hex
+        self.command = command
+        self.owner = owner
+        self.status = status
+        self.result = result
+        self.error = error
+        self.created = created or time.time()
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(**state)
+
+
+class CommandJobs(object):
+    """
+    executor and bounded store of async command jobs
+
+    The executor is created on first use, from settings
+
+        # -- dotted path to a concurrent.futures.Executor class
+        TASTYPIE_CQRS_EXECUTOR = 'concurrent.futures.ThreadPoolExecutor'
+        TASTYPIE_CQRS_MAX_WORKERS = 4
+        # -- use a Django cache instead of the in-process LRU, so that
+        #    jobs can be polled from any process
+        TASTYPIE_CQRS_JOBS_CACHE = 'default'
+        # -- max number of jobs kept in-process, and seconds to keep a job
+        TASTYPIE_CQRS_JOBS_SIZE = 1024
+        TASTYPIE_CQRS_JOBS_TTL = 3600
+
+    Jobs are submitted once the current transaction commits, so that
+    commands see the request's writes (e.g. with ATOMIC_REQUESTS).
+    Commands are called with the request, which cannot be pickled. Thus
+    the executor must run jobs in-process, i.e. only thread pools are
+    supported, a ProcessPoolExecutor does not work.
+    """
+    _prefix = 'tastypiex:cqrs-job:'
+
+    def __init__(self):
+        self._executor = None
+        self._jobs = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                executor_cls = load_class(getattr(settings, 'TASTYPIE_CQRS_EXECUTOR', ThreadPoolExecutor))
+                self._executor = executor_cls(max_workers=getattr(settings, 'TASTYPIE_CQRS_MAX_WORKERS', None))
+            return self._executor
+
+    @property
+    def jobs(self):
+        with self._lock:
+            if self._jobs is None:
+                self._jobs = ExpiringLRUCache(maxsize=getattr(settings, 'TASTYPIE_CQRS_JOBS_SIZE', 1024))
+            return self._jobs
+
+    @property
+    def cache_backend(self):
+        backend = getattr(settings, 'TASTYPIE_CQRS_JOBS_CACHE', None)
+        return caches[backend] if backend else None
+
+    def save(self, job):
+        ttl = getattr(settings, 'TASTYPIE_CQRS_JOBS_TTL', 3600)
+        backend = self.cache_backend
+        if backend is not None:
+            backend.set(self._prefix + job.id, job.as_dict(), timeout=ttl or None)
+        else:
+            self.jobs.set(job.id, job.as_dict(), expires=time.time() + ttl if ttl else None)
+
+    def submit(self, job, fn, *args, **kwargs):
+        """ store the job and run fn(*args, **kwargs) once the current transaction commits
+
+        fn returns the job's result, which must be serializable by the job store.
+        """
+        self.save(job)
+        transaction.on_commit(lambda: self.executor.submit(self.run, job, fn, *args, **kwargs))
+        return job
+
+    def run(self, job, fn, *args, **kwargs):
+        job.status = 'running'
+        self.save(job)
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'failed'
+        self.save(job)
+
+    def get(self, job_id, owner):
+        """ return the job if it exists and is owned by owner, else None """
+        backend = self.cache_backend
+        state = backend.get(self._prefix + job_id) if backend is not None else self.jobs.get(job_id)
+        if state is None or state['owner'] != owner:
+            return None
+        return CommandJob.from_dict(state)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+command_jobs = CommandJobs()
+
+
+class IdempotencyKeyReused(ValueError):
+    """ an Idempotency-Key was reused for a request with a different body """
+    pass
+
+
+class IdempotencyKeyInFlight(ValueError):
+    """ an Idempotency-Key is used by a request that is still running """
+    pass
+
+
+class CommandResponseStore(object):
+    """
+    store of command responses, for Idempotency-Key and cached GET commands
+
+    Responses are kept in-process in a bounded LRU, or in a Django cache
+    to share them between processes. Only the status, content and headers
+    of a response are stored. A key is reserved by reserve() while its
+    request runs, so that concurrent requests with the same key do not
+    run the command again. Reservations expire after a timeout, in case
+    the process running the request dies.
+
+        # -- use a Django cache instead of the in-process LRU
+        TASTYPIE_CQRS_RESPONSE_CACHE = 'default'
+        # -- max number of responses kept in-process
+        TASTYPIE_CQRS_RESPONSE_STORE_SIZE = 1024
+        # -- seconds a key is reserved for a running request
+        TASTYPIE_CQRS_IDEMPOTENCY_LOCK_TTL = 300
+    """
+    _prefix = 'tastypiex:cqrs:'
+
+    def __init__(self):
+        self._local = None
+        self._lock = threading.Lock()
+
+    @property
+    def local(self):
+        with self._lock:
+            if self._local is None:
+                self._local = ExpiringLRUCache(maxsize=getattr(settings, 'TASTYPIE_CQRS_RESPONSE_STORE_SIZE', 1024))
+            return self._local
+
+    @property
+    def cache_backend(self):
+        backend = getattr(settings, 'TASTYPIE_CQRS_RESPONSE_CACHE', None)
+        return caches[backend] if backend else None
+
+    def make_key(self, *parts):
+        return self._prefix + hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key, fingerprint=None):
+        """ return a new HttpResponse for the stored response, or None
+
+        Raises IdempotencyKeyReused if the response was stored for a
+        different request fingerprint, IdempotencyKeyInFlight if the key
+        is reserved by a request that is still running.
+        """
+        backend = self.cache_backend
+        entry = backend.get(key) if backend is not None else self.local.get(key)
+        if entry is None:
+            return None
+        status, content, headers, stored_fingerprint = entry
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyKeyReused(key)
+        if status is None:
+            raise IdempotencyKeyInFlight(key)
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response[header] = value
+        return response
+
+    def set(self, key, response, ttl, fingerprint=None):
+        entry = (response.status_code, response.content, list(response.items()), fingerprint)
+        backend = self.cache_backend
+        if backend is not None:
+            backend.set(key, entry, timeout=ttl)
+        else:
+            self.local.set(key, entry, expires=time.time() + ttl if ttl else None)
+
+    def reserve(self, key, fingerprint=None):
+        """ reserve key for a running request, return False if it is stored or reserved already """
+        entry = (None, None, None, fingerprint)
+        ttl = getattr(settings, 'TASTYPIE_CQRS_IDEMPOTENCY_LOCK_TTL', 300)
+        backend = self.cache_backend
+        if backend is not None:
+            return backend.add(key, entry, timeout=ttl)
+        return self.local.add(key, entry, expires=time.time() + ttl if ttl else None)
+
+    def release(self, key):
+        """ drop the reservation or response of key """
+        backend = self.cache_backend
+        if backend is not None:
+            backend.delete(key)
+        else:
+            self.local.pop(key)
+
+    def clear(self):
+        self.local.clear()
+
+
+command_responses = CommandResponseStore()
+
 
 class CQRSApiMixin(object):
     """
@@ -19,24 +262,107 @@ class CQRSApiMixin(object):
                 return self.create_response(request, data)
 
         This will add url /api/foo/<pk>/xyz/
+
+    Commands are collected once per class, including commands inherited
+    from base classes, see cqrs_commands. URLs and Meta.extra_actions
+    are generated once per resource instance, calling prepend_urls()
+    again does not add them again.
+
+    Single route:
+
+        By default every command adds its own url. With many commands per
+        resource, set
+
+            class Meta:
+                cqrs_single_route = True
+
+        or settings.TASTYPIE_CQRS_SINGLE_ROUTE = True, to add a single url
+        <resource_name>/<pk>/<command>/ per resource that dispatches to the
+        command by a dict lookup. The url is named api_dispatch_command,
+        reverse it with kwargs command=<cqrsname>.
+
+    Batch commands:
+
+        @cqrsapi(batch=True) also adds <resource_name>/<command>/batch/
+        to run the command for a list of pks, given as ?pks=1,2,3 or as
+        a body {"pks": [1, 2, 3]}. Authentication and throttling are
+        checked once, authorization is checked for every pk by its detail
+        path <resource_name>/<pk>/<command>/. The result of every command
+        call is returned in one response. With batch='atomic' all calls run in one
+        transaction, see dispatch_cqrs_batch.
+
+    Async commands:
+
+        @cqrsapi(run_async=True) submits the command to an executor (see
+        CommandJobs) once the request's transaction commits, and returns
+        202 Accepted with {"job", "status_uri"}.
+        Poll <resource_name>/cqrs-jobs/<job>/ for the job's status and,
+        once done, its result. Jobs can only be polled by the user who
+        submitted them.
+
+    Idempotency keys and cached responses:
+
+        If a request to a command has an Idempotency-Key header, the
+        response is stored (see CommandResponseStore) by resource, pk,
+        command, key and user. Requests with the same key get the stored
+        response, with header Idempotent-Replayed: true, without running
+        the command again. While the first request is still running, the
+        key is reserved and requests with the same key are rejected with
+        409 Conflict. Reusing a key with a different request body is
+        rejected with 422 Unprocessable Entity. Responses are kept for
+        settings.TASTYPIE_CQRS_IDEMPOTENCY_TTL seconds (default 1 day),
+        server errors (5xx) are not stored. Use @cqrsapi(idempotent=False)
+        to disable.
+
+        @cqrsapi(cache_ttl=seconds) caches the response of GET requests by
+        path, query, response format and user for the given number of seconds.
     """
+    #: cqrsname => attribute name of all @cqrsapi commands of the class
+    cqrs_commands = MappingProxyType({})
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        commands = {}
+        names = dict.fromkeys(name for klass in reversed(cls.__mro__) for name in vars(klass))
+        for name in names:
+            method = getattr(cls, name, None)
+            if getattr(method, 'cqrsapi', False):
+                commands[method.cqrsname] = name
+        cls.cqrs_commands = MappingProxyType(commands)
+
+    def cqrs_allowed_methods(self, method):
+        """ return the allowed http methods of a command """
+        return method.allowed_methods or self._meta.allowed_methods
 
     def prepend_urls(self):
         """
         prepend command urls as <resource_name>/<uri>/<command>
         """
+        urls = super(CQRSApiMixin, self).prepend_urls()
+        return urls + list(self.cqrs_urls())
+
+    def cqrs_urls(self):
+        """ return the command urls, built once per resource """
+        cqrs_urls = self.__dict__.get('_cqrs_urls')
+        if cqrs_urls is None:
+            cqrs_urls = self.__dict__['_cqrs_urls'] = tuple(self.build_cqrs_urls())
+        return cqrs_urls
+
+    @property
+    def cqrs_single_route(self):
+        return getattr(self._meta, 'cqrs_single_route',
+                       getattr(settings, 'TASTYPIE_CQRS_SINGLE_ROUTE', False))
+
+    def build_cqrs_urls(self):
         from django.urls import re_path as urlfn
 
-        urls = super(CQRSApiMixin, self).prepend_urls()
-        if not hasattr(self._meta, 'extra_actions'):
+        if getattr(self._meta, 'extra_actions', None) is None:
             self._meta.extra_actions = []
-        for name, method in self.__class__.__dict__.items():
-            if not hasattr(method, 'cqrsapi'):
-                continue
-            # link meta information
-            cqrsname = method.cqrsname or name
-            if method.allowed_methods is None:
-                method.allowed_methods = self._meta.allowed_methods
+        urls = self.build_cqrs_batch_route() + self.build_cqrs_job_route()
+        if self.cqrs_single_route:
+            return urls + self.build_cqrs_route()
+        for cqrsname, name in self.cqrs_commands.items():
+            method = getattr(self, name)
             # add url
             # adopted from tastypie.Resource.base_urls
             pattern = r"^(?P<resource_name>%s)/(?P<%s>.*?)/(?P<command>%s)%s$"
@@ -47,19 +373,472 @@ class CQRSApiMixin(object):
                         name="api_dispatch_command_%s" % cqrsname)
             urls.append(url)
             # add to extra actions (used in django-tastypie-swagger)
-            for http_method in method.allowed_methods:
-                action = {
-                    'name': cqrsname,
-                    'summary': "{} a {}".format(cqrsname, self._meta.resource_name),
-                    'notes': method.__doc__,
-                    'response_class': self.__class__,
-                    'http_method': http_method,
-                }
-                self._meta.extra_actions.append(action)
+            self.add_cqrs_actions(cqrsname, method)
         return urls
 
+    def build_cqrs_route(self):
+        """ return a single url for all commands, dispatching by command name """
+        from django.urls import re_path as urlfn
+
+        if not self.cqrs_commands:
+            return []
+        views = {}
+        for cqrsname, name in self.cqrs_commands.items():
+            views[cqrsname] = self.wrap_view(name)
+            self.add_cqrs_actions(cqrsname, getattr(self, name))
+
+        @csrf_exempt
+        def dispatch_command(request, *args, **kwargs):
+            return views[kwargs['command']](request, *args, **kwargs)
+
+        pattern = r"^(?P<resource_name>%s)/(?P<%s>[^/]+)/(?P<command>%s)%s$"
+        args = (self._meta.resource_name, self._meta.detail_uri_name,
+                '|'.join(re.escape(cqrsname) for cqrsname in views), trailing_slash())
+        return [urlfn(pattern % args, dispatch_command, name="api_dispatch_command")]
+
+    def add_cqrs_actions(self, cqrsname, method):
+        extra_actions = self._meta.extra_actions
+        for http_method in self.cqrs_allowed_methods(method):
+            action = {
+                'name': cqrsname,
+                'summary': "{} a {}".format(cqrsname, self._meta.resource_name),
+                'notes': method.__doc__,
+                'response_class': self.__class__,
+                'http_method': http_method,
+            }
+            if action not in extra_actions:
+                extra_actions.append(action)
+
+    def cqrs_authorize(self, request, dispatch):
+        """ check authorization of a command, raise ImmediateHttpResponse if not authorized """
+        authorize = self.cqrs_pipeline(dispatch).authorize
+        if authorize is not None:
+            authorize(request)
+
+    def compile_cqrs_authorize(self, dispatch):
+        """ return a callable(request, path=None, bundle=None) that checks authorization of a command,
+        or None if there is nothing to check
+
+        The authorization method is resolved once. The bundle is only built
+        if authorization is required, i.e. not for tastypie's no-op
+        Authorization, and if not given. The path defaults to request.path.
+        """
+        authorization = self._meta.authorization
+        if not dispatch.cqrsargs['permission'] or not authorization:
+            return None
+        is_authorized = getattr(self, 'is_authorized', None) or getattr(authorization, 'is_authorized', None)
+        if is_authorized is None and type(authorization) is Authorization:
+            # tastypie's Authorization allows everything
+            return None
+        cqrsname = dispatch.cqrsname
+        build_bundle = self.build_bundle
+
+        def authorize(request, path=None, bundle=None):
+            if bundle is None:
+                bundle = build_bundle(request=request)
+            paths = [path or request.path]
+            try:
+                if is_authorized is not None:
+                    # use Resource.is_authorized, or Resource.Meta.authorization.is_authorized, if available
+                    # -- is_authorized() is the generic method for permission authorization
+                    # -- we can pass it the cqrsname as the action
+                    is_authorized(cqrsname, paths, bundle)
+                elif request.method in ('GET', 'HEAD', 'OPTIONS'):
+                    # fall back to standard authorization, using read_list or create_list
+                    # -- standard authorization primitives are of the format <crud>_<list|detail>
+                    #    e.g. read_list, create_list, read_detail, create_detail, etc.
+                    # -- use the request method to derive the action, we simply use the list variant
+                    authorization.read_list(paths, bundle)
+                else:
+                    authorization.create_list(paths, bundle)
+            except Unauthorized:
+                raise ImmediateHttpResponse(HttpUnauthorized())
+
+        return authorize
+
+    def cqrs_pipeline(self, dispatch):
+        """ return the compiled dispatch pipeline of a command, built once per resource """
+        pipelines = self.__dict__.setdefault('_cqrs_pipelines', {})
+        pipeline = pipelines.get(dispatch.cqrsname)
+        if pipeline is None:
+            pipeline = pipelines[dispatch.cqrsname] = self.compile_cqrs_pipeline(dispatch)
+        return pipeline
+
+    def compile_cqrs_pipeline(self, dispatch):
+        """ return a callable(request, *args, **kwargs) that runs a command
+
+        Allowed methods, authorization and the pre_cqrs_dispatch, cqrs_dispatch
+        and post_cqrs_dispatch hooks are resolved once. The callable's
+        authorize attribute is the compiled authorization, or None. Its
+        run_item attribute runs the command for one pk of a batch, see
+        dispatch_cqrs_batch. If
+        settings.TASTYPIE_CQRS_METRICS is True, the phases are instrumented,
+        see tastypiex.metrics.
+        """
+        # this adopted from standard tastypie in Resource.dispatch()
+        # -- main difference here is that we call the @cqrsapi'd method()
+        cqrsargs = {'cqrsargs': dispatch.cqrsargs}
+        allowed = self.cqrs_allowed_methods(dispatch)
+        authenticate = dispatch.cqrsargs['authenticate']
+        authorize = self.compile_cqrs_authorize(dispatch)
+        method = dispatch.cqrs_method
+        run_async = dispatch.run_async
+        caching = dispatch.idempotent or dispatch.cache_ttl
+        is_authenticated = self.is_authenticated
+        throttle_check = self.throttle_check
+
+        def handler(request, *args, **kwargs):
+            return method(self, request, *args, **kwargs)
+
+        metrics = getattr(settings, 'TASTYPIE_CQRS_METRICS', False)
+        if metrics:
+            labels = dict(resource=self._meta.resource_name, command=dispatch.cqrsname)
+            is_authenticated = timed(is_authenticated, self.cqrs_phase_histogram('authentication', labels))
+            if authorize is not None:
+                authorize = timed(authorize, self.cqrs_phase_histogram('authorization', labels))
+            throttle_check = timed(throttle_check, self.cqrs_phase_histogram('throttle', labels))
+            serialization = self.cqrs_phase_histogram('serialization', labels)
+            run_handler = count_queries(timed(handler, self.cqrs_phase_histogram('handler', labels)),
+                                        registry.histogram('tastypie_cqrs_queries', buckets=QUERY_BUCKETS,
+                                                           help='database queries of a command', **labels))
+
+            def handler(request, *args, **kwargs):
+                request._cqrs_serialize_histogram = serialization
+                return run_handler(request, *args, **kwargs)
+
+        def inner_dispatch(request, *args, **kwargs):
+            self.method_check(request, allowed=allowed)
+            if authenticate:
+                is_authenticated(request)
+            if authorize is not None:
+                authorize(request)
+            throttle_check(request)
+            store_key, ttl, fingerprint = (self.get_cqrs_response_key(request, dispatch, kwargs)
+                                           if caching else (None, None, None))
+            # only idempotent requests have a fingerprint, GET requests are not reserved
+            reserve = fingerprint is not None
+            resp = self.get_stored_cqrs_response(request, store_key, fingerprint) if store_key else None
+            if resp is None and reserve and not command_responses.reserve(store_key, fingerprint):
+                # another request stored or reserved the key meanwhile
+                resp = self.get_stored_cqrs_response(request, store_key, fingerprint)
+                if resp is None:
+                    raise ImmediateHttpResponse(self.cqrs_in_flight_response(request))
+            if resp is None:
+                try:
+                    if run_async:
+                        resp = self.submit_cqrs_job(request, dispatch, *args, **kwargs)
+                    else:
+                        resp = handler(request, *args, **kwargs)
+                except BaseException:
+                    if reserve:
+                        command_responses.release(store_key)
+                    raise
+                if store_key and resp.status_code < 500:
+                    command_responses.set(store_key, resp, ttl, fingerprint)
+                elif reserve:
+                    command_responses.release(store_key)
+            self.log_throttled_access(request)
+            return resp
+
+        # setup hooks
+        pre_dispatch = getattr(self, 'pre_cqrs_dispatch', None)
+        real_dispatch = getattr(self, 'cqrs_dispatch', inner_dispatch)
+        post_dispatch = getattr(self, 'post_cqrs_dispatch', None)
+        if pre_dispatch is None and post_dispatch is None:
+            def pipeline(request, *args, **kwargs):
+                return real_dispatch(request, *args, **kwargs, **cqrsargs)
+        else:
+            def pipeline(request, *args, **kwargs):
+                if pre_dispatch is not None:
+                    pre_dispatch(request, *args, **kwargs, **cqrsargs)
+                resp = real_dispatch(request, *args, **kwargs, **cqrsargs)
+                if post_dispatch is not None:
+                    post_dispatch(resp, *args, **kwargs, **cqrsargs)
+                return resp
+
+        def run_item(request, *args, cqrs_path=None, cqrs_bundle=None, **kwargs):
+            # authorization is checked for every item by its detail path, other
+            # checks are done once per batch, unless cqrs_dispatch is overridden
+            if authorize is not None:
+                authorize(request, path=cqrs_path, bundle=cqrs_bundle)
+            if pre_dispatch is not None:
+                pre_dispatch(request, *args, **kwargs, **cqrsargs)
+            if real_dispatch is inner_dispatch:
+                resp = handler(request, *args, **kwargs, **cqrsargs)
+            else:
+                resp = real_dispatch(request, *args, **kwargs, **cqrsargs)
+            if post_dispatch is not None:
+                post_dispatch(resp, *args, **kwargs, **cqrsargs)
+            return resp
+
+        if metrics:
+            pipeline = timed(pipeline, registry.histogram('tastypie_cqrs_command_seconds',
+                                                          help='time of a command call', **labels))
+        pipeline.authorize = authorize
+        pipeline.run_item = run_item
+        return pipeline
+
+    def cqrs_phase_histogram(self, phase, labels):
+        return registry.histogram('tastypie_cqrs_phase_seconds', help='time of a command phase',
+                                  phase=phase, **labels)
+
+    def serialize(self, request, data, format, options=None):
+        histogram = getattr(request, '_cqrs_serialize_histogram', None)
+        if histogram is None:
+            return super(CQRSApiMixin, self).serialize(request, data, format, options=options)
+        start = time.perf_counter()
+        try:
+            return super(CQRSApiMixin, self).serialize(request, data, format, options=options)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    def build_cqrs_batch_route(self):
+        """ return the url for batch commands, <resource_name>/<command>/batch/ """
+        from django.urls import re_path as urlfn
+
+        commands = [cqrsname for cqrsname, name in self.cqrs_commands.items()
+                    if getattr(self, name).batch]
+        if not commands:
+            return []
+        pattern = r"^(?P<resource_name>%s)/(?P<command>%s)/batch%s$"
+        args = (self._meta.resource_name,
+                '|'.join(re.escape(cqrsname) for cqrsname in commands), trailing_slash())
+        return [urlfn(pattern % args, self.wrap_view('dispatch_cqrs_batch'),
+                      name="api_dispatch_command_batch")]
 
-def cqrsapi(method=None, name=None, allowed_methods=None, authenticate=True, permission=True):
+    def build_cqrs_job_route(self):
+        """ return the url to poll async commands, <resource_name>/cqrs-jobs/<job_id>/ """
+        from django.urls import re_path as urlfn
+
+        if not any(getattr(self, name).run_async for name in self.cqrs_commands.values()):
+            return []
+        pattern = r"^(?P<resource_name>%s)/cqrs-jobs/(?P<job_id>[0-9a-f]{32})%s$"
+        args = (self._meta.resource_name, trailing_slash())
+        return [urlfn(pattern % args, self.wrap_view('dispatch_cqrs_job'), name="api_cqrs_job")]
+
+    def get_request_owner(self, request):
+        user = getattr(request, 'user', None)
+        return user.pk if user is not None and user.is_authenticated else None
+
+    def submit_cqrs_job(self, request, dispatch, *args, **kwargs):
+        """ run a command in the executor, return 202 Accepted with the job's status uri """
+        try:
+            # read the body now, the input stream is gone once the response is sent
+            request.body
+        except RawPostDataException:
+            # the body was read as a stream, e.g. multipart form data
+            pass
+        job = CommandJob(dispatch.cqrsname, self.get_request_owner(request))
+        command_jobs.submit(job, self.run_cqrs_job, request, dispatch.cqrs_method, *args, **kwargs)
+        data = {'job': job.id, 'status_uri': self.get_job_uri(job)}
+        response = self.create_response(request, data, response_class=HttpAccepted)
+        if data['status_uri']:
+            response['Location'] = data['status_uri']
+        return response
+
+    def run_cqrs_job(self, request, method, *args, **kwargs):
+        """ run a command in the executor, return its result as {"status", "data"} """
+        try:
+            response = self.wrap_view('dispatch_cqrs_job_method')(request, *args, cqrs_method=method, **kwargs)
+            return {'status': response.status_code, 'data': self.batch_item_data(request, response)}
+        finally:
+            connections.close_all()
+
+    def dispatch_cqrs_job_method(self, request, *args, cqrs_method=None, **kwargs):
+        return cqrs_method(self, request, *args, **kwargs)
+
+    def get_job_uri(self, job):
+        kwargs = self.resource_uri_kwargs()
+        kwargs['job_id'] = job.id
+        try:
+            return self._build_reverse_url('api_cqrs_job', kwargs=kwargs)
+        except NoReverseMatch:
+            return ''
+
+    def dispatch_cqrs_job(self, request, *args, **kwargs):
+        """ return the status of an async command, and its result once done """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        job = command_jobs.get(kwargs['job_id'], self.get_request_owner(request))
+        if job is None:
+            return HttpNotFound()
+        data = {'job': job.id, 'command': job.command, 'status': job.status}
+        if job.status == 'done':
+            data['result'] = job.result
+        elif job.status == 'failed':
+            data['error'] = job.error
+        self.log_throttled_access(request)
+        return self.create_response(request, data)
+
+    def get_cqrs_response_key(self, request, dispatch, kwargs):
+        """ return the store key, ttl and request fingerprint for the response of a command
+
+        GET responses are keyed by path, query, negotiated format and user.
+        Idempotent responses are keyed by resource, pk, command, key and
+        user, the fingerprint is a hash of the request body. Returns
+        (None, None, None) if the response is not to be stored.
+        """
+        if request.method in ('GET', 'HEAD'):
+            if not dispatch.cache_ttl:
+                return None, None, None
+            return (command_responses.make_key('get', self._meta.resource_name, dispatch.cqrsname,
+                                               request.get_full_path(), self.determine_format(request),
+                                               self.get_request_owner(request)),
+                    dispatch.cache_ttl, None)
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not idempotency_key or not dispatch.idempotent:
+            return None, None, None
+        pk = kwargs.get(self._meta.detail_uri_name)
+        return (command_responses.make_key('idempotent', self._meta.resource_name, pk, dispatch.cqrsname,
+                                           idempotency_key, self.get_request_owner(request)),
+                getattr(settings, 'TASTYPIE_CQRS_IDEMPOTENCY_TTL', 86400),
+                self.get_request_fingerprint(request))
+
+    def get_stored_cqrs_response(self, request, store_key, fingerprint):
+        """ return the stored response of a command, or None
+
+        Replayed idempotent responses get the header Idempotent-Replayed.
+        Raises ImmediateHttpResponse with 422 Unprocessable Entity if the
+        Idempotency-Key was used for a different request, or with 409
+        Conflict if the request with the same key is still running.
+        """
+        try:
+            resp = command_responses.get(store_key, fingerprint)
+        except IdempotencyKeyReused:
+            raise ImmediateHttpResponse(self.error_response(
+                request, {'error': 'Idempotency-Key was used for a different request'},
+                response_class=HttpUnprocessableEntity))
+        except IdempotencyKeyInFlight:
+            raise ImmediateHttpResponse(self.cqrs_in_flight_response(request))
+        if resp is not None and fingerprint is not None:
+            resp['Idempotent-Replayed'] = 'true'
+        return resp
+
+    def cqrs_in_flight_response(self, request):
+        return self.error_response(request, {'error': 'a request with this Idempotency-Key is in progress'},
+                                   response_class=HttpConflict)
+
+    def get_request_fingerprint(self, request):
+        """ return a hash of the request body """
+        try:
+            body = request.body
+        except RawPostDataException:
+            # the body was read as a stream, e.g. multipart form data
+            body = repr(sorted(request.POST.lists())).encode('utf-8')
+        return hashlib.sha256(body).hexdigest()
+
+    def get_batch_pks(self, request):
+        """ return the pks of a batch request, from ?pks=1,2,3 or a body {"pks": [1, 2, 3]} """
+        if request.GET.get('pks'):
+            return [pk for pk in request.GET['pks'].split(',') if pk]
+        if not request.body:
+            return []
+        data = self.deserialize(request, request.body,
+                                format=request.META.get('CONTENT_TYPE', 'application/json'))
+        pks = data.get('pks') if isinstance(data, dict) else data
+        if not isinstance(pks, (list, tuple)):
+            raise BadRequest("expected a list of pks")
+        return list(pks)
+
+    def dispatch_cqrs_batch(self, request, *args, **kwargs):
+        """ run a command for a list of pks
+
+        Authentication and throttling are checked once for all pks.
+        Authorization is checked for every pk by its detail path, see
+        get_cqrs_item_path, sharing one bundle. A pk that is not authorized
+        results in status 401 for its item. Returns {"objects": [{"pk", "status", "data"}, ...]} with the
+        status and deserialized response of every command call. For commands
+        declared as @cqrsapi(batch='atomic') all commands run in one
+        transaction that is rolled back if any of them fails (status >= 400),
+        in which case the response status is 400. Every command call runs
+        in its own savepoint, so a failed call does not abort the transaction
+        for the calls that follow.
+
+        The pre_cqrs_dispatch and post_cqrs_dispatch hooks are called for
+        every pk. If the resource overrides cqrs_dispatch, every pk is
+        dispatched by cqrs_dispatch as a single command would be, including
+        its checks.
+        """
+        command = kwargs['command']
+        dispatch = getattr(self, self.cqrs_commands[command])
+        cqrsargs = dispatch.cqrsargs
+        self.method_check(request, allowed=self.cqrs_allowed_methods(dispatch))
+        if cqrsargs['authenticate']:
+            self.is_authenticated(request)
+        self.throttle_check(request)
+        pks = self.get_batch_pks(request)
+        bundle = (self.build_bundle(request=request)
+                  if self.cqrs_pipeline(dispatch).authorize is not None else None)
+        run_item = self.wrap_view('dispatch_cqrs_batch_item')
+        atomic = dispatch.batch == 'atomic'
+        failed = False
+        results = []
+        with transaction.atomic() if atomic else nullcontext():
+            for pk in pks:
+                item_kwargs = dict(kwargs)
+                item_kwargs[self._meta.detail_uri_name] = pk
+                resp = run_item(request, *args, cqrs_dispatch=dispatch, cqrs_atomic=atomic,
+                                cqrs_path=self.get_cqrs_item_path(request, command, pk),
+                                cqrs_bundle=bundle, **item_kwargs)
+                failed = failed or resp.status_code >= 400
+                results.append({
+                    'pk': pk,
+                    'status': resp.status_code,
+                    'data': self.batch_item_data(request, resp),
+                })
+            if atomic and failed:
+                transaction.set_rollback(True)
+        self.log_throttled_access(request)
+        response_class = HttpBadRequest if atomic and failed else HttpResponse
+        return self.create_response(request, {'objects': results}, response_class=response_class)
+
+    def get_cqrs_item_path(self, request, command, pk):
+        """ return the detail path of a command for pk, derived from the batch path """
+        return re.sub(r'(?<=/)%s/batch(/?)$' % re.escape(command),
+                      lambda match: '%s/%s%s' % (pk, command, match.group(1)), request.path)
+
+    def dispatch_cqrs_batch_item(self, request, *args, cqrs_dispatch=None, cqrs_atomic=False, **kwargs):
+        # the savepoint is rolled back by the exception, before wrap_view handles it
+        with transaction.atomic() if cqrs_atomic else nullcontext():
+            return self.cqrs_pipeline(cqrs_dispatch).run_item(request, *args, **kwargs)
+
+    def batch_item_data(self, request, response):
+        content = getattr(response, 'content', None)
+        if not content:
+            return None
+        try:
+            # deserialize by the response's content type, not the request's
+            return self._meta.serializer.deserialize(content, format=response.get('Content-Type', 'application/json'))
+        except (BadRequest, UnsupportedFormat, ValueError):
+            return content.decode(response.charset or 'utf-8', errors='replace')
+
+    def meta_changed(self):
+        self.__dict__.pop('_cqrs_urls', None)
+        self.__dict__.pop('_cqrs_pipelines', None)
+        meta_changed = getattr(super(CQRSApiMixin, self), 'meta_changed', None)
+        if meta_changed is not None:
+            meta_changed()
+
+
+def cqrsapi(method=None, name=None, allowed_methods=None, authenticate=True, permission=True,
+            batch=False, run_async=False, idempotent=True, cache_ttl=None):
+    """
+    declare a CQRS command, see CQRSApiMixin
+
+    Args:
+        method (callable): the command method(self, request, *args, **kwargs)
+        name (str): the command name in the url, defaults to the method's name
+        allowed_methods (list): the allowed http methods, defaults to Meta.allowed_methods
+        authenticate (bool): if True, authenticate the request
+        permission (bool): if True, check Meta.authorization
+        batch (bool|str): if True, add <resource_name>/<command>/batch/ to run the
+            command for a list of pks, if 'atomic' in one transaction
+        run_async (bool): if True, run the command in an executor and return
+            202 Accepted, see CQRSApiMixin
+        idempotent (bool): if True, honor the Idempotency-Key header
+        cache_ttl (int): if set, cache responses to GET requests for this many seconds
+    """
     cqrsargs = dict(cqrsargs=dict(cqrs_method=method,
                                   cqrs_name=name,
                                   allowed_methods=allowed_methods,
@@ -70,54 +849,18 @@ def cqrsapi(method=None, name=None, allowed_methods=None, authenticate=True, per
         # wrap() is called at declaration time and returns dispatch
         # dispatch() is the actual view function, effectively overriding Resource.dispatch
         def dispatch(self, request, *args, **kwargs):
-            # this adopted from standard tastypie in Resource.dispatch()
-            # -- main difference here is that we call the @cqrsapi'd method()
-            def inner_dispatch(request, *args, **kwargs):
-                self.method_check(request, allowed=dispatch.allowed_methods)
-                if authenticate:
-                    self.is_authenticated(request)
-                if permission and self._meta.authorization:
-                    bundle = self.build_bundle(request=request)
-                    if any(hasattr(auth, 'is_authorized') for auth in (self, self._meta.authorization)):
-                        # use Resource.is_authorized, or Resource.Meta.authorization.is_authorized, if available
-                        # -- is_authorized() is the generic method for permission authorization
-                        # -- we can pass it the cqrsname as the action
-                        auth_meth = getattr(self, 'is_authorized', None) or getattr(self._meta.authorization,
-                                                                                    'is_authorized')
-                        auth_args = dispatch.cqrsname, [request.path], bundle
-                    else:
-                        # fall back to standard authorization, using read_list or create_list
-                        # -- standard authorization primitives are of the format <crud>_<list|detail>
-                        #    e.g. read_list, create_list, read_detail, create_detail, etc.
-                        # -- use the request method to derive the action, we simply use the list variant
-                        authorization = self._meta.authorization
-                        action = 'read' if request.method in ('GET', 'HEAD', 'OPTIONS') else 'create'
-                        auth_meth = getattr(authorization, f'{action}_list')
-                        auth_args = [request.path], bundle
-                    try:
-                        auth_meth(*auth_args)
-                    except Unauthorized as e:
-                        raise ImmediateHttpResponse(HttpUnauthorized())
-                self.throttle_check(request)
-                resp = method(self, request, *args, **kwargs)
-                self.log_throttled_access(request)
-                return resp
-
-            # setup hooks
-            noop = lambda *args, **kwargs: None  # noqa
-            pre_dispatch = getattr(self, 'pre_cqrs_dispatch', noop)
-            real_dispatch = getattr(self, 'cqrs_dispatch', inner_dispatch)
-            post_dispatch = getattr(self, 'post_cqrs_dispatch', noop)
-            # do actual dispatching
-            pre_dispatch(request, *args, **kwargs, **cqrsargs)
-            resp = real_dispatch(request, *args, **kwargs, **cqrsargs)
-            post_dispatch(resp, *args, **kwargs, **cqrsargs)
-            return resp
+            return self.cqrs_pipeline(dispatch)(request, *args, **kwargs)
 
         dispatch.cqrsname = name or method.__name__
         dispatch.allowed_methods = allowed_methods
         dispatch.permission = permission if isinstance(permission, str) else None
         dispatch.cqrsapi = True
+        dispatch.cqrsargs = cqrsargs['cqrsargs']
+        dispatch.cqrs_method = method
+        dispatch.batch = batch
+        dispatch.run_async = run_async
+        dispatch.idempotent = idempotent
+        dispatch.cache_ttl = cache_ttl
         dispatch.__doc__ = method.__doc__
         return dispatch
 
@@ -1,9 +1,80 @@
+import threading
+from django.core.signals import setting_changed
+from django.http import HttpResponse
 from tastypie.authentication import Authentication
 from tastypie.authorization import Authorization
-from tastypiex.util import load_class
+from tastypiex.util import load_class, ExpiringLRUCache
 
 
-class DeferredAuthentication(Authentication):
+class BackendRegistry(object):
+    """
+    thread-safe, load-once registry of deferred backends
+
+    Backends are loaded from settings on first use and kept as a tuple
+    per (setting, default_backend), shared by all DeferredAuthentication
+    and DeferredAuthorization instances. Use reload() to drop loaded
+    backends, e.g. when settings change. This happens automatically if
+    settings are changed by the test framework (override_settings).
+    """
+
+    def __init__(self):
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def get(self, setting, default_backend):
+        key = (setting, default_backend)
+        try:
+            return self._backends[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._backends:
+                self._backends[key] = self.load(setting, default_backend)
+            return self._backends[key]
+
+    def load(self, setting, default_backend):
+        from django.conf import settings
+        backends = getattr(settings, setting, default_backend) if setting else default_backend
+        return tuple(load_class(backend_name)() for backend_name in _as_tuple(backends))
+
+    def reload(self, setting=None):
+        """ drop loaded backends, for all settings or the given setting """
+        with self._lock:
+            for key in list(self._backends):
+                if setting is None or key[0] == setting:
+                    del self._backends[key]
+
+
+backend_registry = BackendRegistry()
+
+
+def _as_tuple(backends):
+    return (backends,) if isinstance(backends, str) else tuple(backends)
+
+
+def _reload_backends(setting=None, **kwargs):
+    backend_registry.reload(setting)
+
+
+setting_changed.connect(_reload_backends)
+
+
+class DeferredBackendsMixin(object):
+    """
+    common backend loading for DeferredAuthentication and DeferredAuthorization
+    """
+
+    def load_backends(self):
+        """ (re)load backends from settings """
+        backend_registry.reload(self.setting)
+        return self.backends
+
+    @property
+    def backends(self):
+        return backend_registry.get(self.setting, self.default_backend)
+
+
+class DeferredAuthentication(DeferredBackendsMixin, Authentication):
     """
     instantiate the authentication class at runtime instead
     of at load time. with this, client applications can
@@ -21,30 +92,70 @@ class DeferredAuthentication(Authentication):
         Every backend should needs at least an is_authenticated method.
         It can be derived from tastypie.Authentication or from object, i.e.
         you don't need a dependency to tastypie to make use of it.
+
+        Backends are loaded once per process, see BackendRegistry.
+
+    Adaptive ordering:
+
+        By default backends are tried in the order of the setting. With
+        DeferredAuthentication('SOME_SETTING', adaptive=True) the backends
+        that succeeded most often are tried first. In addition, the backend
+        that succeeded for a credential fingerprint (by default the scheme
+        of the Authorization header, see get_fingerprint) is tried first
+        for subsequent requests of the same fingerprint.
+
+        Only backends that check credentials are reordered. Backends that
+        authenticate any request (tastypie's Authentication, or any backend
+        with always_authenticates = True) are always tried last, in the
+        order of the setting, and are never preferred for a fingerprint.
+
+        In adaptive mode a request is authenticated by any backend that
+        returns True, whatever the order. An HttpResponse returned by a
+        backend (e.g. HttpUnauthorized) does not end the chain, it is only
+        returned if no backend succeeds.
     """
 
     def __init__(self, setting=None,
                  default_backend=None,
-                 require_active=True):
+                 require_active=True,
+                 adaptive=False):
         self.setting = setting
-        self.default_backend = default_backend or ('tastypie.authentication.Authentication',)
-        self._backends = []
-
-    def load_backends(self):
-        from django.conf import settings
-        backends = getattr(settings, self.setting, self.default_backend)
-        if isinstance(backends, str):
-            backends = (backends,)
-        for backend_name in backends:
-            backend = load_class(backend_name)()
-            self._backends.append(backend)
-        return self._backends
-
-    @property
-    def backends(self):
-        return self._backends or self.load_backends()
+        self.default_backend = _as_tuple(default_backend or 'tastypie.authentication.Authentication')
+        self.adaptive = adaptive
+        # backend => number of successful authentications
+        # -- updated without locking, the counts are only used for ordering
+        self._hits = {}
+        # fingerprint => backend that succeeded last
+        self._fingerprints = ExpiringLRUCache(maxsize=128)
+
+    def get_fingerprint(self, request):
+        """ return the credential fingerprint of the request """
+        authorization = request.META.get('HTTP_AUTHORIZATION') or ''
+        return authorization.split(' ', 1)[0].lower()
+
+    def is_fallback(self, backend):
+        """ return True if backend authenticates any request, i.e. does not check credentials """
+        return (getattr(backend, 'always_authenticates', False) or
+                getattr(type(backend), 'is_authenticated', None) is Authentication.is_authenticated)
+
+    def ordered_backends(self, fingerprint):
+        """ return backends by number of hits, the backend known for fingerprint first
+
+        Fallback backends (see is_fallback) come last, in settings order.
+        """
+        hits = self._hits
+        fallbacks = [backend for backend in self.backends if self.is_fallback(backend)]
+        backends = sorted((backend for backend in self.backends if backend not in fallbacks),
+                          key=lambda backend: -hits.get(backend, 0))
+        preferred = self._fingerprints.get(fingerprint)
+        if preferred in backends:
+            backends.remove(preferred)
+            backends.insert(0, preferred)
+        return backends + fallbacks
 
     def is_authenticated(self, request, **kwargs):
+        if self.adaptive:
+            return self._adaptive_is_authenticated(request, **kwargs)
         for backend in self.backends:
             result = backend.is_authenticated(request, **kwargs)
             if result:
@@ -54,6 +165,21 @@ class DeferredAuthentication(Authentication):
                 return result
         return False
 
+    def _adaptive_is_authenticated(self, request, **kwargs):
+        fingerprint = self.get_fingerprint(request)
+        response = False
+        for backend in self.ordered_backends(fingerprint):
+            result = backend.is_authenticated(request, **kwargs)
+            if isinstance(result, HttpResponse):
+                response = response or result
+            elif result:
+                if not self.is_fallback(backend):
+                    self._hits[backend] = self._hits.get(backend, 0) + 1
+                    self._fingerprints.set(fingerprint, backend)
+                request._authentication_backend = backend
+                return result
+        return response
+
     def get_identifier(self, request):
         for backend in self.backends:
             if hasattr(backend, 'get_identifier'):
@@ -71,7 +197,7 @@ class DeferredAuthentication(Authentication):
         return super(DeferredAuthentication, self).check_active(user)
 
 
-class DeferredAuthorization(Authorization):
+class DeferredAuthorization(DeferredBackendsMixin, Authorization):
     """
     instantiate the authorization class at runtime instead
     of at load time. with this, client applications can
@@ -87,28 +213,15 @@ class DeferredAuthorization(Authorization):
             SOME_SETTING = ('path.to.backend', ...)
 
         Define those methods that you require, out of
+
+        Backends are loaded once per process, see BackendRegistry.
     """
 
     def __init__(self, setting=None,
                  default_backend=None,
                  require_active=True):
         self.setting = setting
-        self.default_backend = default_backend or ('tastypie.authorization.Authorization')
-        self._backends = None
-
-    def load_backends(self):
-        from django.conf import settings
-        backends = getattr(settings, self.setting, self.default_backend)
-        if isinstance(backends, str):
-            backends = (backends,)
-        for backend_name in backends:
-            backend = load_class(backend_name)()
-            self._backends.append(backend)
-        return self._backends
-
-    @property
-    def backends(self):
-        return self._backends or self.load_backends()
+        self.default_backend = _as_tuple(default_backend or 'tastypie.authorization.Authorization')
 
     def _check_method(meth):  # @NoSelf
         """
@@ -1,3 +1,7 @@
+from functools import reduce
+
+import operator
+from django.db.models import Q
 from tastypie.exceptions import BadRequest
 from tastypie.fields import ApiField
 
@@ -30,6 +34,15 @@ class FromModelField(ApiField):
              user = FromModelField('user', model=User, model_fields=['username'])
 
         You can also enable multiple fields, e.g. model_fields=['pk', 'username'].
+        By default each field is tried in turn, i.e. one query per field. To
+        always use a single query, specify single_query=True:
+
+             user = FromModelField('user', model=User, model_fields=['pk', 'username'],
+                                   single_query=True)
+
+        This queries Q(pk=key) | Q(username=key), where the first field in
+        model_fields that matches takes precedence. Keys that are not digits
+        are never looked up as a 'pk'.
 
         FromModelField does not verify user permissions. If you need to verify
         user permissions, specify a callable as
@@ -56,23 +69,142 @@ class FromModelField(ApiField):
         possible, it adds a lot of overhead and code for little added value.
 
         FromModelField makes the intent explicit and is faster to implement.
+
+    Batch hydration:
+
+        By default every bundle resolves its URI by one query per entry in
+        model_fields. For list PUT/PATCH requests add FromModelFieldBatchMixin
+        to the resource. This resolves all URIs in the request with one
+        query per model field before hydration. Each bundle then gets its
+        object from a per-request map:
+
+            class FooResource(FromModelFieldBatchMixin, ModelResource):
+                user = FromModelField('user', model=User)
     """
 
     def __init__(self, attribute=None, model=None, model_fields=None,
-                 check_perm=False, **kwargs):
+                 check_perm=False, single_query=False, **kwargs):
         super().__init__(attribute=attribute, **kwargs)
         self.model = model
         self.model_fields = model_fields or ('pk',)
         self.check_perm = check_perm
+        self.single_query = single_query
 
     def try_model_field(self, bundle, field, key):
+        value = self.coerce_key(field, key)
+        if value is None:
+            return False, None
         try:
-            value = int(key) if field == 'pk' else str(key)
             value = self.get_queryset(bundle.request).get(**{field: value})
         except Exception:
             return False, None
         return True, value
 
+    def get_object(self, bundle, key):
+        """
+        get the object for key by one query across all model fields
+
+        The query is Q(field1=key) | Q(field2=key) ..., where the first
+        model field that matches exactly one object takes precedence.
+        If the query returns objects but none matches by value, e.g. due
+        to a case-insensitive collation, each model field is tried in turn.
+        Returns None if no object matches.
+        """
+        lookups = [(field, {value: key}) for field, value in
+                   ((field, self.coerce_key(field, key)) for field in self.model_fields)
+                   if value is not None]
+        if not lookups:
+            return None
+        query = reduce(operator.or_, (Q(**{field: value}) for field, lookup in lookups
+                                      for value in lookup))
+        objects = list(self.get_queryset(bundle.request).filter(query))
+        for field, lookup in lookups:
+            obj = self.match_objects(objects, field, lookup).get(key)
+            if obj is not None:
+                return obj
+        return self.resolve_key(bundle, key) if objects else None
+
+    def resolve_key(self, bundle, key):
+        # return the object for key by trying each model field in turn, or None
+        for field in self.model_fields:
+            worked, obj = self.try_model_field(bundle, field, key)
+            if worked:
+                return obj
+        return None
+
+    def match_objects(self, objects, field, lookup):
+        """
+        map objects to their keys by the value of field
+
+        Args:
+            objects (iterable): the model objects
+            field (str): the model field
+            lookup (dict): mapping of field value => key
+
+        Returns:
+            dict of key => object, or key => None if multiple objects
+            match the same key (ambiguous, as with .get())
+        """
+        get_value = operator.attrgetter(field.replace('__', '.'))
+        matches = {}
+        for obj in objects:
+            value = get_value(obj)
+            key = lookup.get(value if field == 'pk' else str(value))
+            if key is not None:
+                matches[key] = obj if key not in matches else None
+        return matches
+
+    def prefetch(self, request, uris):
+        """
+        resolve all uris by one query per model field
+
+        The resolved objects are kept on the request for use by hydrate().
+        Keys that cannot be matched are stored as None, hydrate() tries
+        each model field in turn for these and raises BadRequest if none
+        matches. This covers values the database matches but that differ
+        from the key, e.g. by case-insensitive collations or UUID format.
+        If single_query is True, all model fields are resolved by one query.
+        """
+        prefetched = self._prefetched(request)
+        pending = {self.uri_key(uri) for uri in uris if isinstance(uri, str)} - set(prefetched)
+        queryset = self.get_queryset(request)
+        lookups = []
+        for field in self.model_fields:
+            lookup = {}
+            for key in pending:
+                value = self.coerce_key(field, key)
+                if value is not None:
+                    lookup[value] = key
+            if lookup:
+                lookups.append((field, lookup))
+        if self.single_query and lookups:
+            query = reduce(operator.or_, (Q(**{'{}__in'.format(field): list(lookup)})
+                                          for field, lookup in lookups))
+            objects = list(queryset.filter(query))
+        for field, lookup in lookups:
+            if not self.single_query:
+                objects = queryset.filter(**{'{}__in'.format(field): list(lookup)})
+            for key, obj in self.match_objects(objects, field, lookup).items():
+                # earlier model fields take precedence
+                if obj is not None and key in pending:
+                    prefetched[key] = obj
+                    pending.discard(key)
+        prefetched.update(dict.fromkeys(pending))
+
+    def _prefetched(self, request):
+        # the per-request map of key => object
+        cache = vars(request).setdefault('_frommodelfield_prefetched', {})
+        return cache.setdefault(id(self), {})
+
+    def uri_key(self, uri):
+        return uri.strip('/').split('/')[-1]
+
+    def coerce_key(self, field, key):
+        # return the lookup value for field, or None if key cannot be one
+        if field == 'pk':
+            return int(key) if key.isdecimal() else None
+        return str(key)
+
     def get_queryset(self, request):
         qs = self.model.objects
         qs = qs.for_request(request) if hasattr(qs, 'for_request') else qs
@@ -84,11 +216,18 @@ class FromModelField(ApiField):
         if uri is None and self.null:
             return None
         try:
-            pk = uri.strip('/').split('/')[-1]
-            for field in self.model_fields:
-                worked, obj = self.try_model_field(bundle, field, pk)
-                if worked:
-                    break
+            pk = self.uri_key(uri)
+            prefetched = self._prefetched(bundle.request)
+            if pk in prefetched:
+                obj = prefetched[pk]
+                if obj is None:
+                    obj = self.resolve_key(bundle, pk)
+                if obj is None:
+                    raise BadRequest('Cannot read data from {uri}'.format(**locals()))
+            elif self.single_query:
+                obj = self.get_object(bundle, pk)
+            else:
+                obj = self.resolve_key(bundle, pk)
         except Exception:
             raise BadRequest('Cannot read data from {uri}'.format(**locals()))
         if self.check_perm:
@@ -98,3 +237,33 @@ class FromModelField(ApiField):
     def dehydrate(self, bundle, for_list=True):
         # by default return whatever was provided as input
         return getattr(bundle.obj, self.attribute, bundle.data.get(self.attribute))
+
+
+class FromModelFieldBatchMixin(object):
+    """
+    Resource mixin to resolve the URIs of all FromModelFields in a request at once
+
+    Usage:
+
+        class FooResource(FromModelFieldBatchMixin, ModelResource):
+            user = FromModelField('user', model=User)
+
+        On a PUT/PATCH of a list (or any other deserialized request), all
+        'user' URIs are resolved by one query per model field, instead of
+        one query per object. See FromModelField.prefetch
+    """
+
+    def deserialize(self, request, data, format='application/json'):
+        deserialized = super(FromModelFieldBatchMixin, self).deserialize(request, data, format=format)
+        self.prefetch_model_fields(request, deserialized)
+        return deserialized
+
+    def prefetch_model_fields(self, request, deserialized):
+        if not isinstance(deserialized, dict):
+            return
+        objects = deserialized.get(self._meta.collection_name)
+        objects = objects if isinstance(objects, list) else [deserialized]
+        for field in self.fields.values():
+            if isinstance(field, FromModelField):
+                field.prefetch(request, [obj.get(field.attribute) for obj in objects
+                                         if isinstance(obj, dict)])
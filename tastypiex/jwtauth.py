@@ -1,9 +1,17 @@
+import hashlib
+import time
+import weakref
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.utils.functional import SimpleLazyObject
 from tastypie.authentication import Authentication
 from tastypie.compat import get_username_field
 from tastypie.http import HttpUnauthorized
 
+from tastypiex.util import ExpiringLRUCache
+
 
 class JWTAuthentication(Authentication):
     """ Handles JWT auth for Tastypie, in which a user provides a valid JWT token
@@ -14,21 +22,64 @@ class JWTAuthentication(Authentication):
                 class Meta:
                     authentication = JWTAuthentication()
 
+    Caching verified tokens:
+
+        Decoding and verifying the token and looking up the user can be
+        skipped for tokens that have been verified before. Verified tokens
+        are kept in a bounded in-process LRU cache, and optionally in a
+        Django cache, until the token expires (its 'exp' claim). Tokens
+        without an 'exp' claim are never cached. On a cache hit, request.user
+        is loaded lazily from the cached user id.
+
+        Cached tokens of a user are evicted when the user is saved or
+        deleted. With a Django cache, the user is also marked as revoked in
+        that cache, and every cache hit checks the mark, so that tokens
+        cached by other processes are not used either.
+
+        # settings
+        # -- number of tokens in the in-process cache, 0 disables caching (default)
+        TASTYPIE_JWT_CACHE_SIZE = 1024
+        # -- name of a Django cache to share tokens across processes, optional
+        TASTYPIE_JWT_CACHE_BACKEND = 'default'
+
+        Instead of settings you can also specify
+        JWTAuthentication(cache_size=value, cache_backend=name).
+
     See Also
         - backend https://github.com/webstack/django-jwt-auth
     """
     auth_type = 'bearer'
+    _cache_prefix = 'tastypiex:jwt:'
+
+    def __init__(self, *args, cache_size=None, cache_backend=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cache_size = cache_size
+        self._cache_backend = cache_backend
+        self._token_cache = None
+        _authentications.add(self)
 
     def _unauthorized(self):
         return HttpUnauthorized()
 
     def extract_credentials(self, request):
-        from jwt_auth import mixins
-        token = mixins.get_token_from_request(request)
-        payload = mixins.get_payload_from_token(token)
-        userid = mixins.jwt_get_user_id_from_payload(payload)
+        token = self.get_token(request)
+        payload = self.get_payload(token)
+        userid = self.get_userid(payload)
         return userid, token
 
+    def get_token(self, request):
+        from jwt_auth import mixins
+        return mixins.get_token_from_request(request)
+
+    def get_payload(self, token):
+        # decode and verify the token
+        from jwt_auth import mixins
+        return mixins.get_payload_from_token(token)
+
+    def get_userid(self, payload):
+        from jwt_auth import mixins
+        return mixins.jwt_get_user_id_from_payload(payload)
+
     def is_authenticated(self, request, **kwargs):
         """
         Finds the user and checks their API key.
@@ -36,16 +87,96 @@ class JWTAuthentication(Authentication):
         Should return either ``True`` if allowed, ``False`` if not or an
         ``HttpResponse`` if you need something custom.
         """
-        from jwt_auth.exceptions import AuthenticationFailed
         # validate credentials in jwt
         try:
-            userid, token = self.extract_credentials(request)
-            user = self._get_user(userid)
+            token = self.get_token(request)
+            user = self.get_cached_user(token)
+            if user is None:
+                payload = self.get_payload(token)
+                user = self._get_user(self.get_userid(payload))
+                self.cache_token(token, payload, user)
         except Exception:
             return self._unauthorized()
         request.user = user
         return True
 
+    @property
+    def token_cache(self):
+        if self._token_cache is None:
+            size = self._cache_size
+            size = size if size is not None else getattr(settings, 'TASTYPIE_JWT_CACHE_SIZE', 0)
+            self._token_cache = ExpiringLRUCache(maxsize=size) if size else False
+        return self._token_cache
+
+    @property
+    def cache_backend(self):
+        backend = self._cache_backend or getattr(settings, 'TASTYPIE_JWT_CACHE_BACKEND', None)
+        return caches[backend] if backend else None
+
+    def _token_key(self, token):
+        return self._cache_prefix + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _revoked_key(cls, userpk):
+        return '{}revoked:{}'.format(cls._cache_prefix, userpk)
+
+    def get_cached_user(self, token):
+        """
+        return the user for a previously verified token, or None
+        """
+        if self.token_cache is False:
+            return None
+        key = self._token_key(token)
+        backend = self.cache_backend
+        entry = self.token_cache.get(key)
+        if entry is None and backend is not None:
+            entry = backend.get(key)
+            if entry is not None:
+                self.token_cache.set(key, entry, expires=entry[1])
+        if entry is None or entry[1] <= time.time():
+            return None
+        userpk, expires, cached = entry
+        if backend is not None:
+            revoked = backend.get(self._revoked_key(userpk))
+            if revoked is not None and revoked >= cached:
+                self.evict_token(token)
+                return None
+        return SimpleLazyObject(lambda: get_user_model().objects.get(pk=userpk))
+
+    def evict_token(self, token):
+        """
+        forget a previously verified token
+        """
+        if self.token_cache is False:
+            return
+        key = self._token_key(token)
+        self.token_cache.pop(key)
+        if self.cache_backend is not None:
+            self.cache_backend.delete(key)
+
+    def cache_token(self, token, payload, user):
+        """
+        remember a verified token until it expires
+        """
+        expires = payload.get('exp')
+        if self.token_cache is False or not isinstance(expires, (int, float)):
+            return
+        key = self._token_key(token)
+        entry = (user.pk, expires, time.time())
+        self.token_cache.set(key, entry, expires=expires)
+        if self.cache_backend is not None:
+            self.cache_backend.set(key, entry, timeout=max(int(expires - time.time()), 1))
+
+    def evict_user(self, userpk):
+        """
+        forget all verified tokens of a user
+        """
+        if self.token_cache is False:
+            return
+        self.token_cache.discard(lambda entry: entry[0] == userpk)
+        if self.cache_backend is not None:
+            self.cache_backend.set(self._revoked_key(userpk), time.time(), timeout=None)
+
     def _get_user(self, userid):
         username_field = get_username_field()
         lookup_kwargs = {username_field: userid}
@@ -54,6 +185,18 @@ class JWTAuthentication(Authentication):
         return user
 
 
+_authentications = weakref.WeakSet()
+
+
+def _evict_user(sender, instance, **kwargs):
+    for authentication in list(_authentications):
+        authentication.evict_user(instance.pk)
+
+
+post_save.connect(_evict_user, sender=settings.AUTH_USER_MODEL, dispatch_uid='tastypiex.jwtauth.user_saved')
+post_delete.connect(_evict_user, sender=settings.AUTH_USER_MODEL, dispatch_uid='tastypiex.jwtauth.user_deleted')
+
+
 def jwt_get_user_id_from_payload_handler(payload):
     # this retrieves the userid from a username, not the userid
     # adapted from jwt_auth.utils.jwt_get_user_id_from_payload_handler
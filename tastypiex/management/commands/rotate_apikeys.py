@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.core.management import BaseCommand, CommandError
+
+from tastypiex.rotapikey import rotate_expired_keys
+from tastypiex.util import seconds
+
+
+class Command(BaseCommand):
+    help = "rotate all expired api keys, see tastypiex.rotapikey.RotatingApiKeyAuthentication"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='number of keys updated per query')
+        parser.add_argument('--duration', default=None,
+                            help='the key duration, e.g. 3600 or 1d, defaults to settings.TASTYPIE_APIKEY_DURATION. '
+                                 'Use this if RotatingApiKeyAuthentication(duration=...) is specified')
+
+    def handle(self, *args, **options):
+        duration = None
+        if options['duration']:
+            duration = seconds(options['duration'])
+            if not duration:
+                raise CommandError('invalid duration {}'.format(options['duration']))
+            duration = timedelta(seconds=duration)
+        rotated = rotate_expired_keys(duration=duration, batch_size=options['batch_size'])
+        self.stdout.write('rotated {} api keys'.format(rotated))
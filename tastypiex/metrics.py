@@ -0,0 +1,178 @@
+"""
+Process-local metrics for tastypie resources
+
+Provides a thread-safe registry of histograms and its export in
+Prometheus text format. CQRSApiMixin feeds the registry with the
+timing of every command phase if enabled in settings:
+
+    # settings.py
+    TASTYPIE_CQRS_METRICS = True
+
+Recorded metrics (labels resource, command and for phases, phase):
+
+    tastypie_cqrs_command_seconds    total time of a command call
+    tastypie_cqrs_phase_seconds      time by phase: authentication,
+                                     authorization, throttle, handler,
+                                     serialization (part of handler)
+    tastypie_cqrs_queries            database queries of the handler,
+                                     on the default database
+
+The _count of tastypie_cqrs_command_seconds is the number of calls,
+i.e. the throughput when scraped periodically. The registry is per
+process, i.e. every worker reports its own metrics.
+
+Usage:
+    # add /api/metrics/ to the urls, see ApiCentralizer(metrics=True)
+    urlpatterns += ApiCentralizer(path=r'api/', metrics=True).urls
+
+    # or add the view yourself
+    urlpatterns += [re_path(r'^metrics/$', metrics_view)]
+
+The view responds to staff users, or to anyone if settings.DEBUG is True.
+"""
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseNotFound
+
+DEFAULT_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram(object):
+    """
+    a thread-safe histogram of observed values
+
+    Args:
+        buckets (tuple): the upper bounds of the buckets, sorted
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative(self):
+        """ return the list of (upper bound, cumulative count), including +Inf """
+        with self._lock:
+            counts = list(self.counts)
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        total = 0
+        cumulative = []
+        for bound, count in zip(bounds, counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class MetricsRegistry(object):
+    """
+    registry of histograms by name and labels
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help=None, buckets=DEFAULT_BUCKETS, **labels):
+        """ return the histogram for name and labels, created on first use """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram(buckets=buckets)
+                    if help:
+                        self._help.setdefault(name, help)
+        return histogram
+
+    def export(self):
+        """ return all histograms in Prometheus text format """
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        lines = []
+        previous = None
+        for (name, labels), histogram in histograms:
+            if name != previous:
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s histogram' % name)
+                previous = name
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', bound),)), count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(float(histogram.sum))))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._help.clear()
+
+
+registry = MetricsRegistry()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+               for key, value in labels)
+    return '{%s}' % ','.join(escaped)
+
+
+def timed(fn, histogram):
+    """ return fn wrapped to observe its duration in histogram, in seconds """
+
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return inner
+
+
+def count_queries(fn, histogram):
+    """ return fn wrapped to observe the number of database queries it runs in histogram """
+
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        queries = [0]
+
+        def counter(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        try:
+            with connection.execute_wrapper(counter):
+                return fn(*args, **kwargs)
+        finally:
+            histogram.observe(queries[0])
+
+    return inner
+
+
+def metrics_view(request, *args, **kwargs):
+    """ return the metrics registry in Prometheus text format """
+    user = getattr(request, 'user', None)
+    if not settings.DEBUG and not getattr(user, 'is_staff', False):
+        return HttpResponseNotFound()
+    return HttpResponse(registry.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
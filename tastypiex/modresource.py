@@ -1,3 +1,12 @@
+import threading
+import weakref
+
+# (base, *mixins) => composed class, see mixin_class
+# -- keys are weak references, entries are dropped with the composed class
+_mixin_classes = weakref.WeakValueDictionary()
+_mixin_classes_lock = threading.Lock()
+
+
 def override_api_meta(api, meta, resources=None):
     """
     override all meta for resources in an api
@@ -21,36 +30,60 @@ def override_api_meta(api, meta, resources=None):
 
 
 def override_resource_meta(resource, meta):
-    """ override meta """
+    """ override meta
+
+    Calls resource.meta_changed(), if available, to let the resource
+    drop anything it has derived from Meta.
+    """
     if meta:
         # override Meta attributes
         for k, v in meta.__dict__.items():
             if k.startswith('__'):
                 continue
             setattr(resource._meta.__class__, k, v)
+        if hasattr(resource, 'meta_changed'):
+            resource.meta_changed()
     return resource
 
 
+def mixin_class(base_cls, *mixins):
+    """ return a class with mixins prepended to base_cls' bases
+
+    Composed classes are memoized by (base_cls, mixins), i.e. applying
+    the same mixins again returns the same class. Mixins that base_cls
+    already has are skipped, if there are none left base_cls is returned
+    as is. The cache holds weak references only, a composed class is
+    garbage collected as soon as it is no longer used.
+    """
+    mixins = tuple(mixin for mixin in dict.fromkeys(mixins) if mixin not in base_cls.__mro__)
+    if not mixins:
+        return base_cls
+    key = tuple(weakref.ref(c) for c in (base_cls,) + mixins)
+    with _mixin_classes_lock:
+        cls = _mixin_classes.get(key)
+        if cls is None:
+            cls = type(base_cls.__name__, mixins + (base_cls,), {})
+            _mixin_classes[key] = cls
+    return cls
+
+
 def add_resource_mixins(obj, *cls):
-    """Apply mixins to a class instance after creation"""
+    """Apply mixins to a class instance after creation
+
+    Mixins the instance already has are not applied (nor initialized)
+    again, see mixin_class.
+    """
     # adopted from http://stackoverflow.com/a/31075641/890242
     base_cls = obj.__class__
-    base_cls_name = obj.__class__.__name__
     # set new type for objects, with mixins pre-pended in type
-    new_bases = list(cls)
-    new_bases.append(base_cls)
-    obj.__class__ = type(base_cls_name, tuple(new_bases), {})
+    obj.__class__ = mixin_class(base_cls, *cls)
     # initialize mixins just added
-    for c in cls:
-        c.__init__(obj)
+    for c in dict.fromkeys(cls):
+        if c not in base_cls.__mro__:
+            c.__init__(obj)
     return cls
 
 
 def add_class_mixins(cls, *mixins):
-    """Apply mixins to a class after creation"""
-    base_cls_name = cls.__name__
-    # set new type for objects, with mixins pre-pended in type
-    new_bases = list(mixins)
-    new_bases.append(cls)
-    cls = type(base_cls_name, tuple(new_bases), {})
-    return cls
+    """Apply mixins to a class after creation, see mixin_class"""
+    return mixin_class(cls, *mixins)
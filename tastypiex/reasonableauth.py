@@ -1,8 +1,68 @@
+import threading
 from django.contrib.auth.models import Permission
-from django.contrib.contenttypes.models import ContentType
+from django.db.models import Model, QuerySet
+from django.db.models.signals import post_delete, post_migrate, post_save
 from tastypie.authorization import DjangoAuthorization
 from tastypie.exceptions import Unauthorized
 
+from tastypiex.authcache import cached_decision
+
+
+class PermissionIndex(object):
+    """
+    process-wide index of all existing permissions
+
+    The index is a frozenset of (app_label, model, codename), loaded by
+    a single query on first use. It is invalidated by the post_migrate
+    signal, i.e. whenever migrations may have added permissions, and
+    whenever a Permission is saved or deleted, e.g. by fixtures or the
+    admin. Permissions changed by other processes are seen after their
+    next migration or restart.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        index = self._index
+        if index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self.load()
+                index = self._index
+        return index
+
+    def load(self):
+        return frozenset(Permission.objects.values_list('content_type__app_label',
+                                                        'content_type__model',
+                                                        'codename'))
+
+    def exists(self, perm, model):
+        if model is None:
+            return False
+        opts = model._meta.concrete_model._meta
+        return (opts.app_label, opts.model_name, perm) in self.index
+
+    def invalidate(self, **kwargs):
+        self._index = None
+
+
+permission_index = PermissionIndex()
+post_migrate.connect(permission_index.invalidate, dispatch_uid='tastypiex.permission_index')
+post_save.connect(permission_index.invalidate, sender=Permission, dispatch_uid='tastypiex.permission_index.saved')
+post_delete.connect(permission_index.invalidate, sender=Permission, dispatch_uid='tastypiex.permission_index.deleted')
+
+
+def object_list_model(object_list):
+    """ return the model of a queryset, model class or model instance, else None """
+    if isinstance(object_list, QuerySet):
+        return object_list.model
+    if isinstance(object_list, Model) or (isinstance(object_list, type) and issubclass(object_list, Model)):
+        return object_list
+    return None
+
 
 class ReasonableDjangoAuthorization(DjangoAuthorization):
     """
@@ -42,31 +102,21 @@ class ReasonableDjangoAuthorization(DjangoAuthorization):
 
     def __init__(self, read_permission='view'):
         super(ReasonableDjangoAuthorization, self).__init__()
-        self._permission_exists = {}
         self.READ_PERM_CODE = read_permission
 
     def check_permission_exists(self, perm, model):
         """
         cached test for existence of a permission
 
-        this tests if the permission exists on the model or model
-        class. it then sets the view_permission_exists property which
-        serves as a cache on subsequent calls. this works because
-        an Authorization instance is always bound to one single tastypie
-        resource, so it is safe to assume we're always asked for the same
-        model / class.
+        this tests if the permission exists on the model, a model instance
+        or a queryset of the model. the test uses the process-wide
+        permission_index, i.e. it does not query the database once the
+        index is loaded, and gives correct answers for any model.
         """
-        if self._permission_exists.get(perm) is not None:
-            return self._permission_exists[perm]
-        try:
-            content_type = ContentType.objects.get_for_model(model)
-            Permission.objects.get(content_type=content_type, codename=perm)
-        except Exception:
-            self._permission_exists[perm] = False
-        else:
-            self._permission_exists[perm] = True
-        return self._permission_exists.get(perm)
+        model = object_list_model(model)
+        return permission_index.exists(perm, model)
 
+    @cached_decision('detail')
     def read_detail(self, object_list, bundle):
         """
         check for read permission
@@ -90,6 +140,7 @@ class ReasonableDjangoAuthorization(DjangoAuthorization):
                                         'delete', bundle.obj)
         raise Unauthorized("You are not allowed to access that resource.")
 
+    @cached_decision('list')
     def read_list(self, object_list, bundle):
         if self.check_permission_exists(self.READ_PERM_CODE, object_list):
             # 'view' permission exist, behavior is implemented in parent class
@@ -104,3 +155,11 @@ class ReasonableDjangoAuthorization(DjangoAuthorization):
             return self.perm_obj_checks(bundle.request,
                                         'delete', object_list)
         return object_list.none()
+
+    # cache decisions per request, see tastypiex.authcache
+    create_list = cached_decision('list')(DjangoAuthorization.create_list)
+    update_list = cached_decision('list')(DjangoAuthorization.update_list)
+    delete_list = cached_decision('list')(DjangoAuthorization.delete_list)
+    create_detail = cached_decision('detail')(DjangoAuthorization.create_detail)
+    update_detail = cached_decision('detail')(DjangoAuthorization.update_detail)
+    delete_detail = cached_decision('detail')(DjangoAuthorization.delete_detail)
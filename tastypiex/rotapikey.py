@@ -1,9 +1,20 @@
+import hashlib
+import logging
+import queue
+import threading
+import time
 from datetime import timedelta
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.db.models.signals import post_save, post_delete
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from tastypie.authentication import ApiKeyAuthentication
 
-from tastypiex.util import seconds
+from tastypiex.util import seconds, ExpiringLRUCache
+
+logger = logging.getLogger(__name__)
 
 
 class RotatingApiKeyAuthentication(ApiKeyAuthentication):
@@ -37,39 +48,295 @@ class RotatingApiKeyAuthentication(ApiKeyAuthentication):
         Instead of settings.TASTYPIE_APIKEY_DURATION you can also specify
         RotatingApiKeyAuthentication(duration=value), which will take precedence
         over settings. This allows per-resource specifics.
+
+    Rotation:
+        By default an expired key is rotated within the request that uses it.
+        To keep the key update off the request path, set
+
+        # -- rotate expired keys in a background thread, in batches
+        TASTYPIE_APIKEY_ROTATION = 'thread'
+        # -- never rotate on requests, use manage.py rotate_apikeys
+        TASTYPIE_APIKEY_ROTATION = 'command'
+
+        In either case an expired key is denied access by comparing its
+        created timestamp, without writing to the database. Keys are rotated
+        in bulk by rotate_expired_keys(). RotatingApiKeyAuthentication(rotation=value)
+        takes precedence over settings.
+
+        manage.py rotate_apikeys uses settings.TASTYPIE_APIKEY_DURATION. If
+        the duration is only given as RotatingApiKeyAuthentication(duration=value),
+        pass it to the command as well, e.g. manage.py rotate_apikeys --duration 1d
+
+    Caching:
+        Validated (username, key) pairs can be cached in-process, so that
+        subsequent requests are authenticated without database access. An entry
+        expires after the cache ttl. The key's created timestamp is cached along,
+        so that each hit checks the key's expiry against this instance's duration.
+        Entries are evicted when the user's ApiKey or the user is saved or deleted,
+        e.g. on rotation or by the admin. On a cache hit, request.user is loaded
+        lazily.
+
+        # -- seconds to cache a validated key, 0 disables caching (default)
+        TASTYPIE_APIKEY_CACHE_TTL = 300
+        # -- max number of cached keys
+        TASTYPIE_APIKEY_CACHE_SIZE = 1024
+
+        RotatingApiKeyAuthentication(cache_ttl=value) takes precedence over settings.
     """
     _magic_postfix = '#p'
 
-    def __init__(self, *args, duration=None, **kwargs):
+    def __init__(self, *args, duration=None, rotation=None, cache_ttl=None, **kwargs):
         self._apikey_duration = duration
+        self._rotation = rotation
+        self._cache_ttl = cache_ttl
         super().__init__(*args, **kwargs)
 
+    @property
+    def cache_ttl(self):
+        ttl = self._cache_ttl
+        return seconds(ttl if ttl is not None else getattr(settings, 'TASTYPIE_APIKEY_CACHE_TTL', 0))
+
+    def is_authenticated(self, request, **kwargs):
+        ttl = self.cache_ttl
+        if not ttl:
+            return super().is_authenticated(request, **kwargs)
+        try:
+            username, api_key = self.extract_credentials(request)
+        except ValueError:
+            username = api_key = None
+        if username and api_key:
+            entry = key_cache.get(username, api_key)
+            if entry is not None and not self.key_expired(entry[1]):
+                userpk = entry[0]
+                request.user = SimpleLazyObject(lambda: get_user_model().objects.get(pk=userpk))
+                return True
+        result = super().is_authenticated(request, **kwargs)
+        if result is True:
+            key_cache.set(username, api_key, request.user.pk, self.key_created(request.user),
+                          expires=time.time() + ttl)
+        return result
+
+    def key_created(self, user):
+        # the created timestamp of the user's current key, None if it never expires
+        if is_permanent_key(user.api_key.key, user.username):
+            return None
+        return user.api_key.created
+
+    def key_expired(self, created, now=timezone.now):
+        # True if a key created at created has expired for this instance's duration
+        duration = apikey_duration(self._apikey_duration)
+        return bool(duration) and created is not None and now() > created + duration
+
     def get_key(self, user, api_key, now=timezone.now):
-        # check the key twice
-        # -- first, check the key as is
-        # -- second, check the key with the magic postfix (if user does not provide)
-        valid = super().get_key(user, api_key)
-        valid = valid if valid is True else super().get_key(user, api_key + self._magic_postfix)
-        rotated = self.maybe_rotate_key(user, now=now) if valid is True else False
-        return self._unauthorized() if rotated else valid
-
-    def maybe_rotate_key(self, user, now=timezone.now):
+        # check the key as is, or with the magic postfix (if user does not provide)
+        key = self.lookup_key(user, api_key)
+        if key is None:
+            return self._unauthorized()
+        rotated = self.maybe_rotate_key(user, now=now, api_key=key)
+        return self._unauthorized() if rotated else True
+
+    def lookup_key(self, user, api_key):
+        """ return the user's ApiKey if it matches api_key, with or without the magic postfix
+
+        Uses user.api_key if it is loaded already (e.g. by select_related() in
+        ApiKeyAuthentication.is_authenticated), else a single query for either
+        key form. The ApiKey, including its created timestamp, is cached on the
+        user so that no further query is required.
+
+        Returns:
+            the ApiKey, or None if the key does not match
+        """
+        from tastypie.models import ApiKey
+        candidates = (api_key, api_key + self._magic_postfix)
+        if type(user).api_key.is_cached(user):
+            try:
+                key = user.api_key
+            except ApiKey.DoesNotExist:
+                return None
+            return key if key.key in candidates else None
+        key = ApiKey.objects.filter(user=user, key__in=candidates).first()
+        if key is not None:
+            user.api_key = key
+        return key
+
+    def maybe_rotate_key(self, user, now=timezone.now, api_key=None):
         # rotate the key if the current key has expired
-        # return True if a new key has been generated, else False
+        # return True if the key has expired (and a new key is or will be generated), else False
         # usernames listed in settings.TASTYPIE_APIKEY_PERMANENT are never expired
-        if (user.api_key.key.endswith(getattr(settings, 'TASTYPIE_APIKEY_PERMANENT_POSTFIX', self._magic_postfix))
-                or user.username in (getattr(settings, 'TASTYPIE_APIKEY_PERMANENT', None) or [])):
+        api_key = api_key or user.api_key
+        if is_permanent_key(api_key.key, user.username):
             return False
-        duration = seconds(getattr(settings, 'TASTYPIE_APIKEY_DURATION', self._apikey_duration))
+        duration = apikey_duration(self._apikey_duration)
         if duration:
-            duration = duration if isinstance(duration, dict) else {'seconds': int(duration)}
-            if 'years' in duration:
-                duration['weeks'] = 52 * duration.pop('years')
-            valid_dt = user.api_key.created + timedelta(**duration)
+            valid_dt = api_key.created + duration
             expired = now() > valid_dt
             if expired:
-                user.api_key.key = user.api_key.generate_key()
-                user.api_key.created = timezone.now()
-                user.api_key.save()
+                rotation = self._rotation or getattr(settings, 'TASTYPIE_APIKEY_ROTATION', 'sync')
+                if rotation == 'sync':
+                    api_key.key = api_key.generate_key()
+                    api_key.created = timezone.now()
+                    api_key.save()
+                elif rotation == 'thread':
+                    rotation_scheduler.schedule(api_key.pk, duration=duration)
                 return True
         return False
+
+
+def apikey_duration(default=None):
+    """ return the duration of api keys as a timedelta, or None if keys do not expire """
+    duration = seconds(getattr(settings, 'TASTYPIE_APIKEY_DURATION', default))
+    if duration:
+        duration = duration if isinstance(duration, dict) else {'seconds': int(duration)}
+        if 'years' in duration:
+            duration['weeks'] = 52 * duration.pop('years')
+        return timedelta(**duration)
+    return None
+
+
+def is_permanent_key(key, username):
+    # keys with the permanent postfix and keys of users in TASTYPIE_APIKEY_PERMANENT never expire
+    postfix = getattr(settings, 'TASTYPIE_APIKEY_PERMANENT_POSTFIX', RotatingApiKeyAuthentication._magic_postfix)
+    return key.endswith(postfix) or username in (getattr(settings, 'TASTYPIE_APIKEY_PERMANENT', None) or [])
+
+
+def rotate_expired_keys(duration=None, now=timezone.now, pks=None, batch_size=500):
+    """ rotate all expired api keys in bulk
+
+    Args:
+        duration (timedelta): the key duration, defaults to apikey_duration()
+        now (callable): returns the current time
+        pks (list): optional, the ApiKey pks to consider, defaults to all keys
+        batch_size (int): number of keys updated per query
+
+    Returns:
+        number of keys rotated
+    """
+    from tastypie.models import ApiKey
+    duration = duration or apikey_duration()
+    if not duration:
+        return 0
+    postfix = getattr(settings, 'TASTYPIE_APIKEY_PERMANENT_POSTFIX', RotatingApiKeyAuthentication._magic_postfix)
+    created = now()
+    expired = (ApiKey.objects
+               .filter(created__lt=created - duration)
+               .exclude(key__endswith=postfix)
+               .exclude(user__username__in=getattr(settings, 'TASTYPIE_APIKEY_PERMANENT', None) or [])
+               .only('pk', 'key', 'created'))
+    if pks is not None:
+        expired = expired.filter(pk__in=pks)
+    rotated = 0
+    batch = []
+    for api_key in expired.iterator(chunk_size=batch_size):
+        api_key.key = api_key.generate_key()
+        api_key.created = created
+        batch.append(api_key)
+        if len(batch) >= batch_size:
+            rotated += ApiKey.objects.bulk_update(batch, ['key', 'created']) or len(batch)
+            batch = []
+    if batch:
+        rotated += ApiKey.objects.bulk_update(batch, ['key', 'created']) or len(batch)
+    return rotated
+
+
+class KeyRotationScheduler(object):
+    """ rotate expired api keys in a background thread
+
+    Requests queue the pk of an expired key by schedule(). The worker
+    thread collects queued pks into batches and rotates them using
+    rotate_expired_keys(). Keys are only rotated if they are still expired,
+    i.e. a key queued multiple times is rotated once.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def schedule(self, pk, duration=None):
+        self.queue.put((pk, duration))
+        self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='tastypiex-apikey-rotation',
+                                                daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            scheduled = [self.queue.get()]
+            while len(scheduled) < self.batch_size:
+                try:
+                    scheduled.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batches = {}
+            for pk, duration in scheduled:
+                batches.setdefault(duration, set()).add(pk)
+            try:
+                for duration, pks in batches.items():
+                    rotate_expired_keys(duration=duration, pks=pks, batch_size=self.batch_size)
+            except Exception:
+                logger.exception('could not rotate api keys')
+            finally:
+                close_old_connections()
+                for item in scheduled:
+                    self.queue.task_done()
+
+
+rotation_scheduler = KeyRotationScheduler()
+
+
+class ValidatedKeyCache(object):
+    """ in-process cache of validated api keys, by username
+
+    Stores a hash of the validated key, the user's pk and the key's
+    created timestamp (None for permanent keys). Entries are evicted when the user's ApiKey or the user is saved or deleted.
+    """
+
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = ExpiringLRUCache(maxsize=getattr(settings, 'TASTYPIE_APIKEY_CACHE_SIZE', 1024))
+        return self._cache
+
+    def _hash(self, api_key):
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def get(self, username, api_key):
+        """ return (user pk, key created) if api_key is cached for username, else None """
+        entry = self.cache.get(username)
+        if entry is None or entry[0] != self._hash(api_key):
+            return None
+        return entry[1:]
+
+    def set(self, username, api_key, userpk, created=None, expires=None):
+        self.cache.set(username, (self._hash(api_key), userpk, created), expires=expires)
+
+    def evict(self, username):
+        self.cache.pop(username)
+
+    def clear(self):
+        self.cache.clear()
+
+
+key_cache = ValidatedKeyCache()
+
+
+def _evict_apikey(sender, instance, **kwargs):
+    key_cache.evict(instance.user.get_username())
+
+
+def _evict_user(sender, instance, **kwargs):
+    key_cache.evict(instance.get_username())
+
+
+post_save.connect(_evict_apikey, sender='tastypie.ApiKey', dispatch_uid='tastypiex.rotapikey.apikey_saved')
+post_delete.connect(_evict_apikey, sender='tastypie.ApiKey', dispatch_uid='tastypiex.rotapikey.apikey_deleted')
+post_save.connect(_evict_user, sender=settings.AUTH_USER_MODEL, dispatch_uid='tastypiex.rotapikey.user_saved')
+post_delete.connect(_evict_user, sender=settings.AUTH_USER_MODEL, dispatch_uid='tastypiex.rotapikey.user_deleted')
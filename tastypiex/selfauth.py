@@ -1,7 +1,14 @@
+from functools import reduce
+
+import operator
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q, QuerySet
 from tastypie.authorization import Authorization
 from tastypie.compat import get_module_name
 from tastypie.exceptions import Unauthorized
 
+from tastypiex.authcache import cached_decision
+
 
 class SelfAuthorization(Authorization):
     """
@@ -27,6 +34,16 @@ class SelfAuthorization(Authorization):
              authorization (that is, the user must have both Django
              permission and the object must belong to them). If a
              string, will use user.has_perm() to check the same
+
+    Notes:
+        For list actions on a QuerySet the check_fields are translated
+        into a database filter (see get_perm_filter), i.e. the object list
+        is returned as a lazy, filtered QuerySet. Objects are only checked
+        one by one using check_obj_perm if the object list is not a QuerySet,
+        or if any of the check_fields cannot be expressed as a lookup (e.g.
+        a property or a multi-valued relation).
+
+        Decisions are cached per request, see tastypiex.authcache.
     """
 
     def __init__(self, allow_staff=True, actions='crud', check_fields=None,
@@ -63,6 +80,47 @@ class SelfAuthorization(Authorization):
                 allowed |= (check_obj is not None and check_obj == request_user)
         return allowed
 
+    def get_perm_filter(self, model, bundle):
+        """
+        return the Q filter equivalent of check_obj_perm for model objects
+
+        Returns:
+            Q filter, or None if any of the check_fields cannot be resolved
+            to a single-valued relation to the user model. A Q object
+            that matches nothing is returned if none of check_fields apply
+            to the model.
+        """
+        request_user = bundle.request.user
+        user_model = request_user._meta.concrete_model
+        filters = []
+        for field in self.check_fields:
+            if field == 'self':
+                if model._meta.concrete_model is user_model:
+                    filters.append(Q(pk=request_user.pk))
+                continue
+            path = field.split('.')
+            related_model = self._resolve_relation(model, path)
+            if related_model is None:
+                if len(path) == 1 and not hasattr(model, field):
+                    # same as getattr(obj, field, None) in check_obj_perm
+                    continue
+                return None
+            if related_model._meta.concrete_model is user_model:
+                filters.append(Q(**{'__'.join(path): request_user}))
+        return reduce(operator.or_, filters) if filters else Q(pk__in=[])
+
+    def _resolve_relation(self, model, path):
+        # follow path of single-valued relations, return the final related model
+        for name in path:
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if not field.is_relation or field.many_to_many or field.one_to_many:
+                return None
+            model = field.related_model
+        return model
+
     def check_django_perm(self, scope, action, object_list, bundle):
         if isinstance(self.require_perm, str) and bundle.request.user.has_perm(self.require_perm):
             return True
@@ -91,37 +149,62 @@ class SelfAuthorization(Authorization):
             if self.require_perm:
                 self.check_django_perm(scope, action, object_list, bundle)
             # check object permissions
+            if scope == 'list' and isinstance(object_list, QuerySet):
+                filtered = self.filter_queryset(object_list, bundle)
+                if filtered.exists():
+                    # the decision depends on the list's content, return a copy to not cache it
+                    return filtered.all() if filtered is object_list else filtered
+                raise Unauthorized("You are not allowed to access that resource.")
             objects_to_check = (object_list if scope == 'list' else [bundle.obj])
             filtered = [obj for obj in objects_to_check if self.check_obj_perm(obj, bundle)]
             if filtered:
                 return filtered if scope == 'list' else True
         raise Unauthorized("You are not allowed to access that resource.")
 
+    def filter_queryset(self, object_list, bundle):
+        # reduce the queryset in the database, if possible
+        if self.is_superuser(bundle):
+            return object_list
+        perm_filter = self.get_perm_filter(object_list.model, bundle)
+        if perm_filter is None:
+            # fall back to checking objects one by one
+            allowed = [obj.pk for obj in object_list if self.check_obj_perm(obj, bundle)]
+            return object_list.filter(pk__in=allowed)
+        return object_list.filter(perm_filter)
+
     def check_list(self, object_list, bundle, action):
         if self.action_allowed(action, bundle):
-            return object_list if self.check_perm('list', action, object_list, bundle) else []
+            return self.check_perm('list', action, object_list, bundle)
         raise Unauthorized("You are not allowed to access that resource.")
 
+    @cached_decision('list')
     def create_list(self, object_list, bundle):
         return self.check_list(object_list, bundle, 'create')
 
+    @cached_decision('list')
     def read_list(self, object_list, bundle):
         return self.check_list(object_list, bundle, 'read')
 
+    @cached_decision('list')
     def update_list(self, object_list, bundle):
         return self.check_list(object_list, bundle, 'update')
 
+    @cached_decision('list')
     def delete_list(self, object_list, bundle):
         return self.check_list(object_list, bundle, 'delete')
 
+    @cached_decision('detail')
     def create_detail(self, object_list, bundle):
         return self.action_allowed('create', bundle) and self.check_perm('detail', 'create', object_list, bundle)
 
+    @cached_decision('detail')
     def read_detail(self, object_list, bundle):
         return self.action_allowed('read', bundle) and self.check_perm('detail', 'read', object_list, bundle)
 
+    @cached_decision('detail')
     def update_detail(self, object_list, bundle):
         return self.action_allowed('update', bundle) and self.check_perm('detail', 'update', object_list, bundle)
 
+    @cached_decision('detail')
     def delete_detail(self, object_list, bundle):
         return self.action_allowed('delete', bundle) and self.check_perm('detail', 'delete', object_list, bundle)
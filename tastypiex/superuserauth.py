@@ -1,11 +1,15 @@
 from tastypie.authorization import Authorization
 from tastypie.exceptions import Unauthorized
 
+from tastypiex.authcache import cached_decision
+
 
 class SuperuserAuthoriziation(Authorization):
     """
     for any action, only allow super users, optionally staff
     this does not check for any other permissions
+
+    decisions are cached per request, see tastypiex.authcache
     """
 
     def __init__(self, allow_staff=False, **kwargs):
@@ -25,26 +29,34 @@ class SuperuserAuthoriziation(Authorization):
             return True
         raise Unauthorized("You are not allowed to access that resource.")
 
+    @cached_decision('detail')
     def create_detail(self, object_list, bundle):
         return self.is_allowed_or_raise(bundle)
 
+    @cached_decision('detail')
     def read_detail(self, object_list, bundle):
         return self.is_allowed_or_raise(bundle)
 
+    @cached_decision('detail')
     def update_detail(self, object_list, bundle):
         return self.is_allowed_or_raise(bundle)
 
+    @cached_decision('detail')
     def delete_detail(self, object_list, bundle):
         return object_list if self.is_allowed_or_raise(bundle) else []
 
+    @cached_decision('list')
     def create_list(self, object_list, bundle):
         return object_list if self.is_allowed_or_raise(bundle) else []
 
+    @cached_decision('list')
     def read_list(self, object_list, bundle):
         return object_list if self.is_allowed_or_raise(bundle) else []
 
+    @cached_decision('list')
     def update_list(self, object_list, bundle):
         return object_list if self.is_allowed_or_raise(bundle) else []
 
+    @cached_decision('list')
     def delete_list(self, object_list, bundle):
         return object_list if self.is_allowed_or_raise(bundle) else []
@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of CORSResourceMixin.wrap_view
+
+Compares the per-call overhead of the view returned by wrap_view,
+
+    before: tastypie's wrap_view built on every request (the previous
+            implementation, reproduced below)
+    after:  CORSResourceMixin.wrap_view, built once per view
+
+over calling the view method directly.
+
+Usage:
+    python -m tastypiex.tests.bench_cors [--number 200000] [--repeat 3]
+    make bench
+"""
+import argparse
+import os
+import timeit
+import warnings
+
+
+def setup():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'example.settings')
+    import django
+    django.setup()
+
+
+def uncached_wrap_view(resource, view):
+    # the previous CORSResourceMixin.wrap_view, building tastypie's wrapper per request
+    from django.views.decorators.csrf import csrf_exempt
+    from tastypiex.cors import CORSResourceMixin
+
+    @csrf_exempt
+    def wrapper(request, *args, **kwargs):
+        request.format = kwargs.pop('format', None)
+        wrapped_view = super(CORSResourceMixin, resource).wrap_view(view)
+        return wrapped_view(request, *args, **kwargs)
+
+    return wrapper
+
+
+def run(number=200000, repeat=3):
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from tastypiex.cors import CORSResource
+
+    class FooResource(CORSResource):
+        class Meta:
+            resource_name = 'foo'
+
+        def ping(self, request, **kwargs):
+            return HttpResponse('ok')
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        resource = FooResource()
+    request = RequestFactory().get('/')
+    views = (
+        ('before', uncached_wrap_view(resource, 'ping')),
+        ('after', resource.wrap_view('ping')),
+    )
+    results = {}
+    for label, view in views:
+        runs = []
+        for i in range(repeat):
+            total = timeit.timeit(lambda: view(request), number=number)
+            base = timeit.timeit(lambda: resource.ping(request), number=number)
+            runs.append((total - base) / number * 1e6)
+        results[label] = runs
+        print('%-6s overhead per call: %s us' % (label, ' / '.join('%.1f' % run for run in runs)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=200000, help='calls per run')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs')
+    args = parser.parse_args()
+    setup()
+    run(number=args.number, repeat=args.repeat)
+
+
+if __name__ == '__main__':
+    main()
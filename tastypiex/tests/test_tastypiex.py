@@ -1,4 +1,5 @@
 import os
+import weakref
 from datetime import timedelta
 from django.contrib.auth.models import User
 from django.test import TestCase
@@ -214,3 +215,1057 @@ class TastypieXTestCases(TestCase):
         self.assertEqual(seconds('1y'), timedelta(days=365).total_seconds())
         self.assertEqual(seconds(hours=5), timedelta(hours=5).total_seconds())
         self.assertEqual(seconds(days=365), timedelta(days=365).total_seconds())
+
+    def test_selfauth_read_list_filters_queryset(self):
+        # test SelfAuthorization reduces a queryset in the database
+        from tastypie.bundle import Bundle
+        from tastypie.exceptions import Unauthorized
+        from tastypie.models import ApiKey
+        from tastypiex.selfauth import SelfAuthorization
+        user = User.objects.create_user('testuser')
+        other = User.objects.create_user('otheruser')
+        ApiKey.objects.get_or_create(user=user)
+        ApiKey.objects.get_or_create(user=other)
+        bundle = Bundle(request=Mock(user=user))
+        auth = SelfAuthorization()
+        # -- 'user' field is a lookup
+        object_list = auth.read_list(ApiKey.objects.all(), bundle)
+        self.assertEqual(list(object_list), [user.api_key])
+        # -- 'self' on the user model
+        object_list = auth.read_list(User.objects.all(), bundle)
+        self.assertEqual(list(object_list), [user])
+        # -- non-queryset object lists are checked object by object
+        object_list = auth.read_list([user.api_key, other.api_key], bundle)
+        self.assertEqual(object_list, [user.api_key])
+        # -- no objects allowed
+        with self.assertRaises(Unauthorized):
+            auth.read_list(ApiKey.objects.filter(user=other), bundle)
+        # -- superusers see all objects
+        user.is_superuser = True
+        object_list = auth.read_list(ApiKey.objects.all(), bundle)
+        self.assertEqual(object_list.count(), 2)
+
+    def test_frommodelfield_batch(self):
+        # test FromModelField resolves all uris of a request at once
+        from django.http import HttpRequest
+        from tastypie.bundle import Bundle
+        from tastypie.exceptions import BadRequest
+        from tastypiex.fromfield import FromModelField
+        users = [User.objects.create_user('user{}'.format(i)) for i in range(5)]
+        field = FromModelField('user', model=User, model_fields=['pk', 'username'])
+        request = HttpRequest()
+        uris = ['/api/v1/user/{}/'.format(user.pk) for user in users[:3]]
+        uris += ['/api/v1/user/user3/', '/api/v1/user/unknown/']
+        with self.assertNumQueries(2):
+            field.prefetch(request, uris)
+        with self.assertNumQueries(0):
+            for uri, user in zip(uris[:4], users):
+                bundle = Bundle(data={'user': uri}, request=request)
+                self.assertEqual(field.hydrate(bundle), user)
+        with self.assertRaises(BadRequest):
+            field.hydrate(Bundle(data={'user': '/api/v1/user/unknown/'}, request=request))
+        # -- uris not prefetched are resolved as before
+        bundle = Bundle(data={'user': '/api/v1/user/user4/'}, request=request)
+        self.assertEqual(field.hydrate(bundle), users[4])
+        # -- keys that are not valid for int() are never looked up as a pk
+        request = HttpRequest()
+        field.prefetch(request, ['/api/v1/user/\u00b2/'])
+        with self.assertRaises(BadRequest):
+            field.hydrate(Bundle(data={'user': '/api/v1/user/\u00b2/'}, request=request))
+        # -- objects the database matches by a value unequal to the key, e.g. by a
+        #    case-insensitive collation, are resolved by field
+
+        class NoMatchField(FromModelField):
+            def match_objects(self, objects, field, lookup):
+                list(objects)
+                return {}
+
+        field = NoMatchField('user', model=User, model_fields=['pk', 'username'])
+        request = HttpRequest()
+        field.prefetch(request, ['/api/v1/user/user3/'])
+        bundle = Bundle(data={'user': '/api/v1/user/user3/'}, request=request)
+        self.assertEqual(field.hydrate(bundle), users[3])
+        field.single_query = True
+        bundle = Bundle(data={'user': '/api/v1/user/user2/'}, request=HttpRequest())
+        self.assertEqual(field.hydrate(bundle), users[2])
+
+    def test_frommodelfield_single_query(self):
+        # test FromModelField looks up all model_fields in one query
+        from django.http import HttpRequest
+        from tastypie.bundle import Bundle
+        from tastypiex.fromfield import FromModelField
+        user = User.objects.create_user('testuser')
+        # -- a username that is another user's pk, pk takes precedence
+        other = User.objects.create_user(str(user.pk))
+        field = FromModelField('user', model=User, model_fields=['pk', 'username'],
+                               single_query=True)
+        for key, expected in ((user.pk, user), ('testuser', user), (other.pk, other)):
+            bundle = Bundle(data={'user': '/api/v1/user/{}/'.format(key)}, request=HttpRequest())
+            with self.assertNumQueries(1):
+                self.assertEqual(field.hydrate(bundle), expected)
+        for key in ('unknown', '999'):
+            bundle = Bundle(data={'user': '/api/v1/user/{}/'.format(key)}, request=HttpRequest())
+            with self.assertNumQueries(1):
+                self.assertIsNone(field.hydrate(bundle))
+
+    def test_jwt_token_cache(self):
+        # test JWTAuthentication skips verification for cached tokens
+        import time
+        from django.test import RequestFactory
+        from django.core.cache import caches
+        from tastypiex.jwtauth import JWTAuthentication, _authentications
+        user = User.objects.create_user('testuser')
+        payloads = {
+            'valid': {'username': 'testuser', 'exp': time.time() + 60},
+            'expired': {'username': 'testuser', 'exp': time.time() - 1},
+        }
+
+        class TestJWTAuthentication(JWTAuthentication):
+            verified = 0
+
+            def get_token(self, request):
+                return request.META['HTTP_AUTHORIZATION']
+
+            def get_payload(self, token):
+                self.verified += 1
+                return payloads[token]
+
+            def get_userid(self, payload):
+                return payload['username']
+
+        auth = TestJWTAuthentication(cache_size=10)
+        self.assertTrue(auth.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION='valid')))
+        for i in range(2):
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION='valid')
+            with self.assertNumQueries(0):
+                self.assertTrue(auth.is_authenticated(request))
+            self.assertEqual(request.user.pk, user.pk)
+        self.assertEqual(auth.verified, 1)
+        # -- deleted users are no longer authenticated by cached tokens
+        user.delete()
+        self.assertEqual(len(auth.token_cache), 0)
+        response = auth.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION='valid'))
+        self.assertIsInstance(response, HttpUnauthorized)
+        user = User.objects.create_user('testuser')
+        self.assertTrue(auth.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION='valid')))
+        self.assertEqual(auth.verified, 3)
+        # -- with a Django cache, users saved in other processes are marked as revoked
+        caches['default'].clear()
+        auth = TestJWTAuthentication(cache_size=10, cache_backend='default')
+        other = TestJWTAuthentication(cache_size=10, cache_backend='default')
+        self.assertTrue(auth.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION='valid')))
+        self.assertTrue(other.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION='valid')))
+        self.assertEqual(other.verified, 0)
+        # -- other does not receive the signal, as if it ran in another process
+        _authentications.discard(other)
+        user.save()
+        self.assertTrue(other.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION='valid')))
+        self.assertEqual(other.verified, 1)
+        caches['default'].clear()
+        auth.verified = 0
+        # -- expired tokens are never cached
+        for i in range(2):
+            auth.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION='expired'))
+        self.assertEqual(auth.verified, 2)
+        # -- caching is disabled by default
+        auth = TestJWTAuthentication()
+        for i in range(2):
+            self.assertTrue(auth.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION='valid')))
+        self.assertEqual(auth.verified, 2)
+
+    def test_deferred_auth_backends_loaded_once(self):
+        # test DeferredAuthentication backends are loaded once and shared
+        from tastypiex.deferredauth import DeferredAuthorization
+        with self.settings(SOME_AUTH=['tastypie.authentication.Authentication']):
+            auth = DeferredAuthentication('SOME_AUTH')
+            backends = auth.backends
+            self.assertIsInstance(backends, tuple)
+            self.assertIs(auth.backends, backends)
+            self.assertIs(DeferredAuthentication('SOME_AUTH').backends, backends)
+            self.assertEqual(len(backends), 1)
+        # -- changing settings reloads backends
+        with self.settings(SOME_AUTH=['tastypie.authentication.Authentication',
+                                      'tastypie.authentication.BasicAuthentication']):
+            self.assertEqual(len(auth.backends), 2)
+        # -- the default backend is used if the setting does not exist
+        authz = DeferredAuthorization('NO_SUCH_SETTING')
+        self.assertEqual(len(authz.backends), 1)
+        self.assertEqual(authz.read_list([1], None), [1])
+
+    def test_deferred_auth_adaptive(self):
+        # test adaptive DeferredAuthentication tries successful backends first
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        from tastypie.authentication import ApiKeyAuthentication, SessionAuthentication
+        from tastypie.models import ApiKey
+        user = User.objects.create_user('testuser')
+        apikey, created = ApiKey.objects.get_or_create(user=user)
+        backends = ['tastypie.authentication.SessionAuthentication',
+                    'tastypie.authentication.ApiKeyAuthentication']
+        header = 'ApiKey testuser:{}'.format(apikey.key)
+        with self.settings(SOME_AUTH=backends):
+            auth = DeferredAuthentication('SOME_AUTH', adaptive=True)
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION=header)
+            request.user = AnonymousUser()
+            self.assertIs(auth.is_authenticated(request), True)
+            self.assertIsInstance(request._authentication_backend, ApiKeyAuthentication)
+            self.assertIsInstance(auth.ordered_backends('apikey')[0], ApiKeyAuthentication)
+            # -- a failed api key does not prevent other backends
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION='ApiKey testuser:invalid')
+            request.user = user
+            request._dont_enforce_csrf_checks = True
+            self.assertIs(auth.is_authenticated(request), True)
+            self.assertIsInstance(request._authentication_backend, SessionAuthentication)
+            # -- no backend succeeds
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION='ApiKey testuser:invalid')
+            request.user = AnonymousUser()
+            self.assertIsInstance(auth.is_authenticated(request), HttpUnauthorized)
+
+    def test_deferred_auth_adaptive_fallback_last(self):
+        # test adaptive DeferredAuthentication never prefers backends that authenticate anyone
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        from tastypie.authentication import ApiKeyAuthentication
+        from tastypie.models import ApiKey
+        user = User.objects.create_user('testuser')
+        apikey, created = ApiKey.objects.get_or_create(user=user)
+        backends = ['tastypie.authentication.ApiKeyAuthentication',
+                    'tastypie.authentication.Authentication']
+        with self.settings(SOME_AUTH=backends):
+            auth = DeferredAuthentication('SOME_AUTH', adaptive=True)
+            for i in range(5):
+                request = RequestFactory().get('/')
+                request.user = AnonymousUser()
+                self.assertIs(auth.is_authenticated(request), True)
+            self.assertIsInstance(auth.ordered_backends('apikey')[0], ApiKeyAuthentication)
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION='ApiKey testuser:{}'.format(apikey.key))
+            request.user = AnonymousUser()
+            self.assertIs(auth.is_authenticated(request), True)
+            self.assertEqual(request.user, user)
+
+    def test_authorization_decisions_cached_per_request(self):
+        # test authorization decisions are computed once per request
+        from tastypie.bundle import Bundle
+        from tastypie.exceptions import Unauthorized
+        from tastypie.models import ApiKey
+        from tastypiex.selfauth import SelfAuthorization
+        from tastypiex.superuserauth import SuperuserAuthoriziation
+        user = User.objects.create_user('testuser')
+        apikey, created = ApiKey.objects.get_or_create(user=user)
+        request = Mock(spec=['user'], user=user)
+        auth = SelfAuthorization()
+        with patch.object(auth, 'check_obj_perm', wraps=auth.check_obj_perm) as check_obj_perm:
+            for i in range(3):
+                self.assertTrue(auth.read_detail(None, Bundle(obj=apikey, request=request)))
+            self.assertEqual(check_obj_perm.call_count, 1)
+            # -- a new request computes the decision again
+            self.assertTrue(auth.read_detail(None, Bundle(obj=apikey, request=Mock(spec=['user'], user=user))))
+            self.assertEqual(check_obj_perm.call_count, 2)
+        auth = SuperuserAuthoriziation()
+        with patch.object(auth, 'is_superuser', wraps=auth.is_superuser) as is_superuser:
+            for i in range(3):
+                with self.assertRaises(Unauthorized):
+                    auth.read_detail(None, Bundle(obj=apikey, request=request))
+            self.assertEqual(is_superuser.call_count, 1)
+            user.is_superuser = True
+            object_list = ApiKey.objects.all()
+            self.assertIs(auth.read_list(object_list, Bundle(request=request)), object_list)
+            object_list = ApiKey.objects.filter(user=user)
+            self.assertIs(auth.read_list(object_list, Bundle(request=request)), object_list)
+            self.assertEqual(is_superuser.call_count, 2)
+        # -- write decisions depend on the hydrated object and are not cached
+        other = User.objects.create_user('other')
+        auth = SelfAuthorization()
+        user.is_superuser = False
+        bundle = Bundle(obj=apikey, request=request)
+        self.assertTrue(auth.update_detail(None, bundle))
+        apikey.user = other
+        with self.assertRaises(Unauthorized):
+            auth.update_detail(None, bundle)
+        # -- a pass that depends on the list's content is not reused for other lists
+        user.is_superuser = True
+        self.assertEqual(auth.read_list(ApiKey.objects.all(), Bundle(request=request)).count(), 1)
+        with self.assertRaises(Unauthorized):
+            auth.read_list(ApiKey.objects.none(), Bundle(request=request))
+
+    def test_permission_index(self):
+        # test ReasonableDjangoAuthorization permission discovery uses a process-wide index
+        from django.db.models.signals import post_migrate
+        from tastypie.models import ApiKey
+        from tastypiex.reasonableauth import ReasonableDjangoAuthorization, permission_index
+        permission_index.invalidate()
+        auth = ReasonableDjangoAuthorization()
+        with self.assertNumQueries(1):
+            self.assertTrue(auth.check_permission_exists('add_user', User))
+            self.assertTrue(auth.check_permission_exists('view_user', User.objects.all()))
+            self.assertFalse(auth.check_permission_exists('view', User()))
+            # -- answers are per model
+            self.assertTrue(auth.check_permission_exists('add_apikey', ApiKey))
+            self.assertFalse(auth.check_permission_exists('add_apikey', User))
+        # -- migrations invalidate the index
+        self.assertIn(permission_index.invalidate, [receiver[1]() for receiver in post_migrate.receivers])
+        permission_index.invalidate()
+        with self.assertNumQueries(1):
+            self.assertTrue(auth.check_permission_exists('add_user', User))
+        # -- permissions created or deleted at runtime invalidate the index
+        from django.contrib.auth.models import Permission
+        from django.contrib.contenttypes.models import ContentType
+        self.assertFalse(auth.check_permission_exists('approve_user', User))
+        permission = Permission.objects.create(codename='approve_user', name='Can approve user',
+                                               content_type=ContentType.objects.get_for_model(User))
+        self.assertTrue(auth.check_permission_exists('approve_user', User))
+        permission.delete()
+        self.assertFalse(auth.check_permission_exists('approve_user', User))
+
+    def test_reasonable_auth_plain_list(self):
+        # test ReasonableDjangoAuthorization accepts object lists that are not querysets
+        from django.test import RequestFactory
+        from tastypie.bundle import Bundle
+        from tastypiex.reasonableauth import ReasonableDjangoAuthorization
+        auth = ReasonableDjangoAuthorization()
+        self.assertFalse(auth.check_permission_exists('view_user', ['/x/']))
+        bundle = Bundle(request=RequestFactory().get('/x/'))
+        self.assertEqual(auth.read_list(['/x/'], bundle), ['/x/'])
+
+    def test_rotating_apikey_single_lookup(self):
+        # test RotatingApiKeyAuthentication checks both key forms by one query
+        from tastypie.models import ApiKey
+        from tastypiex.rotapikey import RotatingApiKeyAuthentication
+        user = User.objects.create_user('testuser')
+        apikey, created = ApiKey.objects.get_or_create(user=user)
+        apikey.key = apikey.key + RotatingApiKeyAuthentication._magic_postfix
+        apikey.save()
+        current_key = apikey.key.replace(RotatingApiKeyAuthentication._magic_postfix, '')
+        auth = RotatingApiKeyAuthentication()
+        with self.settings(TASTYPIE_APIKEY_DURATION={'days': 5}):
+            for key, valid in ((current_key, True), ('invalid', False)):
+                user = User.objects.get(pk=user.pk)
+                with self.assertNumQueries(1):
+                    self.assertEqual(auth.get_key(user, key) is True, valid)
+            # -- no query if api_key is loaded already
+            user = User.objects.select_related('api_key').get(pk=user.pk)
+            with self.assertNumQueries(0):
+                self.assertIs(auth.get_key(user, current_key), True)
+                self.assertIsInstance(auth.get_key(user, 'invalid'), HttpUnauthorized)
+
+    def test_rotating_apikey_deferred_rotation(self):
+        # test expired keys are denied without rotation, and rotated in bulk
+        from tastypie.models import ApiKey
+        from tastypiex.rotapikey import RotatingApiKeyAuthentication, rotate_expired_keys
+        users = [User.objects.create_user('testuser{}'.format(i)) for i in range(3)]
+        apikeys = [ApiKey.objects.get_or_create(user=user)[0] for user in users]
+        current_keys = [apikey.key for apikey in apikeys]
+        auth = RotatingApiKeyAuthentication(rotation='command')
+        future_dt = lambda: timezone.now() + timedelta(days=6)
+        with self.settings(TASTYPIE_APIKEY_DURATION={'days': 5},
+                           TASTYPIE_APIKEY_PERMANENT=[users[2].username]):
+            # -- no update query (user.api_key is loaded already)
+            with self.assertNumQueries(0):
+                self.assertIsInstance(auth.get_key(users[0], current_keys[0], now=future_dt),
+                                      HttpUnauthorized)
+            self.assertEqual(ApiKey.objects.get(user=users[0]).key, current_keys[0])
+            # -- rotate in bulk, users in TASTYPIE_APIKEY_PERMANENT are exempt
+            self.assertEqual(rotate_expired_keys(now=future_dt, batch_size=1), 2)
+            self.assertEqual(rotate_expired_keys(now=future_dt), 0)
+        new_keys = [ApiKey.objects.get(user=user).key for user in users]
+        self.assertNotEqual(new_keys[0], current_keys[0])
+        self.assertNotEqual(new_keys[1], current_keys[1])
+        self.assertEqual(new_keys[2], current_keys[2])
+
+    def test_rotate_apikeys_command(self):
+        # test manage.py rotate_apikeys rotates by settings or --duration
+        from io import StringIO
+        from django.core.management import call_command
+        from tastypie.models import ApiKey
+        from tastypiex.management.commands.rotate_apikeys import Command
+        user = User.objects.create_user('testuser')
+        apikey, created = ApiKey.objects.get_or_create(user=user)
+        ApiKey.objects.filter(pk=apikey.pk).update(created=timezone.now() - timedelta(days=2))
+        with self.settings():
+            from django.conf import settings
+            del settings.TASTYPIE_APIKEY_DURATION
+            stdout = StringIO()
+            call_command(Command(), stdout=stdout)
+            self.assertEqual(stdout.getvalue().strip(), 'rotated 0 api keys')
+            call_command(Command(), duration='1d', stdout=stdout)
+            self.assertIn('rotated 1 api keys', stdout.getvalue())
+        self.assertNotEqual(ApiKey.objects.get(pk=apikey.pk).key, apikey.key)
+
+    def test_key_rotation_scheduler(self):
+        # test KeyRotationScheduler rotates queued keys in batches by duration
+        from tastypiex.rotapikey import KeyRotationScheduler
+        scheduler = KeyRotationScheduler(batch_size=10)
+        day, week = timedelta(days=1), timedelta(days=7)
+        for pk, duration in ((1, day), (2, day), (1, day), (3, week)):
+            scheduler.queue.put((pk, duration))
+        with patch('tastypiex.rotapikey.rotate_expired_keys', side_effect=[Exception('failed'), 1]) as rotate:
+            with self.assertLogs('tastypiex.rotapikey', 'ERROR'):
+                scheduler.start()
+                scheduler.queue.join()
+            # -- a failing batch is logged and does not stop the worker
+            scheduler.schedule(4, duration=day)
+            scheduler.queue.join()
+        self.assertEqual(rotate.call_args_list[0][1], dict(duration=day, pks={1, 2}, batch_size=10))
+        self.assertEqual(rotate.call_args_list[-1][1], dict(duration=day, pks={4}, batch_size=10))
+
+    def test_rotating_apikey_cache(self):
+        # test validated api keys are cached until rotated
+        from django.test import RequestFactory
+        from tastypie.models import ApiKey
+        from tastypiex.rotapikey import RotatingApiKeyAuthentication, key_cache
+        user = User.objects.create_user('testuser')
+        apikey, created = ApiKey.objects.get_or_create(user=user)
+        auth = RotatingApiKeyAuthentication(cache_ttl=60)
+        header = 'ApiKey testuser:{}'.format(apikey.key)
+        key_cache.clear()
+        self.assertIs(auth.is_authenticated(RequestFactory().get('/', HTTP_AUTHORIZATION=header)), True)
+        with self.assertNumQueries(0):
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION=header)
+            self.assertIs(auth.is_authenticated(request), True)
+        self.assertEqual(request.user.pk, user.pk)
+        # -- other keys are not accepted from the cache
+        self.assertIsInstance(auth.is_authenticated(RequestFactory().get(
+            '/', HTTP_AUTHORIZATION='ApiKey testuser:invalid')), HttpUnauthorized)
+        # -- rotating the key evicts the cache entry
+        apikey.key = apikey.generate_key()
+        apikey.save()
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=header)
+        self.assertIsInstance(auth.is_authenticated(request), HttpUnauthorized)
+        # -- each instance checks cached keys against its own duration
+        key_cache.clear()
+        header = 'ApiKey testuser:{}'.format(apikey.key)
+        ApiKey.objects.filter(pk=apikey.pk).update(created=timezone.now() - timedelta(hours=2))
+        long_auth = RotatingApiKeyAuthentication(cache_ttl=60, duration=dict(days=1))
+        short_auth = RotatingApiKeyAuthentication(cache_ttl=60, duration=dict(hours=1),
+                                                  rotation='command')
+        with self.settings():
+            from django.conf import settings
+            del settings.TASTYPIE_APIKEY_DURATION
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION=header)
+            self.assertIs(long_auth.is_authenticated(request), True)
+            with self.assertNumQueries(0):
+                request = RequestFactory().get('/', HTTP_AUTHORIZATION=header)
+                self.assertIs(long_auth.is_authenticated(request), True)
+            request = RequestFactory().get('/', HTTP_AUTHORIZATION=header)
+            self.assertIsInstance(short_auth.is_authenticated(request), HttpUnauthorized)
+
+    def test_cleanfields_plan(self):
+        # test CleanBundleFieldsMixin applies Meta.fields/excludes to detail and list data
+        from tastypie.bundle import Bundle
+        from tastypiex.cleanfields import CleanBundleFieldsMixin
+        from tastypiex.modresource import override_resource_meta
+
+        class FooResource(CleanBundleFieldsMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                fields = ['a', 'b']
+                excludes = ['b']
+
+        class CustomMeta:
+            fields = []
+            excludes = ['a']
+            exclude_uri = True
+
+        resource = FooResource()
+        data = {'a': 1, 'b': 2, 'c': 3, 'resource_uri': '/foo/1/'}
+        bundle = Bundle(data=dict(data))
+        self.assertEqual(resource.alter_detail_data_to_serialize(None, bundle),
+                         {'a': 1, 'resource_uri': '/foo/1/'})
+        bundles = [Bundle(data=dict(data)) for i in range(3)]
+        listdata = resource.alter_list_data_to_serialize(None, {'objects': bundles})
+        self.assertEqual([bundle.data for bundle in listdata['objects']],
+                         [{'a': 1, 'resource_uri': '/foo/1/'}] * 3)
+        # -- changing Meta rebuilds the plan
+        override_resource_meta(resource, CustomMeta)
+        bundle = Bundle(data=dict(data))
+        self.assertEqual(resource.alter_detail_data_to_serialize(None, bundle), {'b': 2, 'c': 3})
+
+    def test_cleanfields_skips_excluded_fields(self):
+        # test CleanBundleFieldsMixin does not dehydrate excluded fields
+        from tastypie import fields
+        from tastypie.bundle import Bundle
+        from tastypie.resources import ModelResource
+        from tastypiex.cleanfields import CleanBundleFieldsMixin
+        user = User.objects.create_user('testuser', email='test@example.com')
+
+        class UserResource(CleanBundleFieldsMixin, ModelResource):
+            mail = fields.CharField(attribute='email')
+            dehydrated = []
+
+            class Meta:
+                queryset = User.objects.all()
+                resource_name = 'user'
+                excludes = ['password', 'email', 'mail']
+                defer_excluded = True
+
+            def dehydrate_mail(self, bundle):
+                self.dehydrated.append('mail')
+
+        resource = UserResource()
+        object_list = resource.get_object_list(None)
+        self.assertEqual(object_list.query.deferred_loading, ({'email', 'password'}, True))
+        # -- columns are only deferred if enabled
+        resource._meta.defer_excluded = False
+        self.assertEqual(resource.get_object_list(None).query.deferred_loading, (frozenset(), True))
+        resource._meta.defer_excluded = True
+        bundle = resource.full_dehydrate(Bundle(obj=object_list.get(pk=user.pk)))
+        self.assertNotIn('mail', bundle.data)
+        self.assertEqual(bundle.data['username'], 'testuser')
+        self.assertEqual(resource.dehydrated, [])
+
+    def test_cleanfields_sparse_fieldsets(self):
+        # test ?fields=a,b limits dehydrated fields and queried columns
+        from django.test import RequestFactory
+        from tastypie.bundle import Bundle
+        from tastypie.resources import ModelResource
+        from tastypiex.cleanfields import CleanBundleFieldsMixin
+        user = User.objects.create_user('testuser', email='test@example.com')
+
+        class UserResource(CleanBundleFieldsMixin, ModelResource):
+            class Meta:
+                queryset = User.objects.all()
+                resource_name = 'user'
+                fields = ['id', 'username', 'email', 'first_name']
+                defer_excluded = True
+
+        resource = UserResource()
+        request = RequestFactory().get('/', {'fields': 'username,password'})
+        object_list = resource.get_object_list(request)
+        self.assertEqual(object_list.query.deferred_loading, ({'email', 'first_name'}, True))
+        # -- the detail uri column is never deferred
+        resource._meta.detail_uri_name = 'username'
+        request = RequestFactory().get('/', {'fields': 'email'})
+        object_list = resource.get_object_list(request)
+        self.assertEqual(object_list.query.deferred_loading, ({'first_name'}, True))
+        with self.assertNumQueries(1):
+            for obj in object_list:
+                resource.get_resource_uri(obj)
+        resource._meta.detail_uri_name = 'pk'
+        request = RequestFactory().get('/', {'fields': 'username,password'})
+        object_list = resource.get_object_list(request)
+        bundle = resource.full_dehydrate(Bundle(obj=object_list.get(pk=user.pk), request=request))
+        self.assertEqual(set(bundle.data), {'username', 'resource_uri'})
+        data = resource.alter_detail_data_to_serialize(request, bundle)
+        self.assertEqual(set(data), {'username', 'resource_uri'})
+        # -- without ?fields all fields allowed by Meta are returned
+        request = RequestFactory().get('/')
+        bundle = resource.full_dehydrate(Bundle(obj=user, request=request))
+        self.assertEqual(set(bundle.data), {'id', 'username', 'email', 'first_name', 'resource_uri'})
+
+    def test_cors_wrap_view_built_once(self):
+        # test CORSResourceMixin builds tastypie's view wrapper once per view
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from tastypiex.cors import CORSResource
+
+        class FooResource(CORSResource):
+            class Meta:
+                resource_name = 'foo'
+
+            def ping(self, request, **kwargs):
+                return HttpResponse(request.format)
+
+        with self.assertWarns(DeprecationWarning):
+            resource = FooResource()
+        with patch.object(Resource, 'wrap_view', autospec=True, side_effect=Resource.wrap_view) as wrap_view:
+            view = resource.wrap_view('ping')
+            self.assertIs(resource.wrap_view('ping'), view)
+            for i in range(3):
+                response = view(RequestFactory().get('/'), format='json')
+                self.assertEqual(response.content, b'json')
+            self.assertEqual(wrap_view.call_count, 1)
+
+    def test_cors_preflight_fast_path(self):
+        # test OPTIONS is answered without authentication or tastypie dispatch
+        from django.test import RequestFactory
+        from tastypie.authentication import Authentication
+        from tastypie.exceptions import ImmediateHttpResponse
+        from tastypiex.cors import CORSResource
+
+        class FooResource(CORSResource):
+            class Meta:
+                resource_name = 'foo'
+                list_allowed_methods = ['get', 'post']
+                detail_allowed_methods = ['get']
+                cors_max_age = 600
+                authentication = Authentication()
+
+        with self.assertWarns(DeprecationWarning):
+            resource = FooResource()
+        with patch.object(Authentication, 'is_authenticated') as is_authenticated, \
+                patch.object(Resource, 'dispatch') as dispatch:
+            response = resource.wrap_view('dispatch_list')(RequestFactory().options('/'))
+            is_authenticated.assert_not_called()
+            dispatch.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Allow'], 'GET,POST')
+        self.assertEqual(response['Access-Control-Max-Age'], '600')
+        self.assertEqual(response['Access-Control-Allow-Origin'], '*')
+        response = resource.wrap_view('dispatch_detail')(RequestFactory().options('/'))
+        self.assertEqual(response['Allow'], 'GET')
+        # -- headers are computed once per allowed methods
+        self.assertIs(resource.preflight_headers(['get']), resource.preflight_headers(['get']))
+        # -- method_check answers the same preflight
+        with self.assertRaises(ImmediateHttpResponse) as cm:
+            resource.method_check(RequestFactory().options('/'), allowed=['get'])
+        self.assertEqual(cm.exception.response['Access-Control-Max-Age'], '600')
+
+    def test_cors_policy_origins(self):
+        # test CORSPolicy allows listed and wildcard origins and varies by Origin
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from tastypiex.cors import CORSPolicy, CORSResource
+
+        policy = CORSPolicy(origins=['https://app.example.com', 'https://*.example.org'])
+        self.assertEqual(policy.allowed_origin('https://app.example.com'), 'https://app.example.com')
+        self.assertEqual(policy.allowed_origin('https://a.b.example.org'), 'https://a.b.example.org')
+        self.assertIsNone(policy.allowed_origin('https://evil.com/.example.org'))
+        self.assertIsNone(policy.allowed_origin('https://example.org'))
+        self.assertIsNone(policy.allowed_origin(None))
+        # -- header sets are immutable and computed once
+        headers = policy.headers('https://app.example.com', 'expose')
+        self.assertIs(policy.headers('https://app.example.com', 'expose'), headers)
+        with self.assertRaises(TypeError):
+            headers['Access-Control-Allow-Origin'] = '*'
+        self.assertEqual(headers['Access-Control-Expose-Headers'], 'Location')
+
+        class FooResource(CORSResource):
+            class Meta:
+                resource_name = 'foo'
+                cors_policy = policy
+
+        with self.assertWarns(DeprecationWarning):
+            resource = FooResource()
+        request = RequestFactory().get('/', HTTP_ORIGIN='https://app.example.com')
+        response = resource.add_cors_headers(HttpResponse(), request=request)
+        self.assertEqual(response['Access-Control-Allow-Origin'], 'https://app.example.com')
+        self.assertEqual(response['Vary'], 'Origin')
+        request = RequestFactory().options('/', HTTP_ORIGIN='https://evil.com')
+        response = resource.wrap_view('dispatch_list')(request)
+        self.assertNotIn('Access-Control-Allow-Origin', response)
+        self.assertEqual(response['Vary'], 'Origin')
+        # -- the default policy allows any origin, without Vary
+        response = CORSPolicy().apply(HttpResponse(), origin='https://evil.com')
+        self.assertEqual(response['Access-Control-Allow-Origin'], '*')
+        self.assertNotIn('Vary', response)
+        # -- credentials cannot be allowed for any origin
+        from django.core.exceptions import ImproperlyConfigured
+        with self.assertRaises(ImproperlyConfigured):
+            CORSPolicy(origins='*', allow_credentials=True)
+        policy = CORSPolicy(origins=['https://app.example.com'], allow_credentials=True)
+        headers = policy.headers('https://app.example.com')
+        self.assertEqual(headers['Access-Control-Allow-Credentials'], 'true')
+        self.assertEqual(policy.headers('https://evil.com'), {})
+
+    def test_cqrs_commands_registry(self):
+        # test CQRSApiMixin collects inherited commands once and builds urls idempotently
+        from django.http import HttpResponse
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi
+
+        class BaseResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'base'
+
+            @cqrsapi
+            def approve(self, request, *args, **kwargs):
+                return HttpResponse('approved')
+
+        class FooResource(BaseResource):
+            class Meta:
+                resource_name = 'foo'
+                allowed_methods = ['post']
+
+            @cqrsapi(name='do-reject')
+            def reject(self, request, *args, **kwargs):
+                return HttpResponse('rejected')
+
+        self.assertEqual(dict(BaseResource.cqrs_commands), {'approve': 'approve'})
+        self.assertEqual(dict(FooResource.cqrs_commands), {'approve': 'approve', 'do-reject': 'reject'})
+        resource = FooResource()
+        urls = resource.prepend_urls()
+        self.assertEqual(sorted(url.name for url in urls),
+                         ['api_dispatch_command_approve', 'api_dispatch_command_do-reject'])
+        self.assertEqual(len(resource.prepend_urls()), 2)
+        self.assertEqual(len(resource._meta.extra_actions), 2)
+        self.assertEqual({action['http_method'] for action in resource._meta.extra_actions}, {'post'})
+        # -- allowed methods are not leaked into the decorated method
+        self.assertIsNone(BaseResource.approve.allowed_methods)
+
+    def test_cqrs_single_route(self):
+        # test Meta.cqrs_single_route adds one url dispatching to all commands
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi
+
+        class FooResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                cqrs_single_route = True
+                allowed_methods = ['post']
+
+            @cqrsapi(authenticate=False, permission=False)
+            def approve(self, request, *args, **kwargs):
+                return HttpResponse('approved %s' % kwargs['pk'])
+
+            @cqrsapi(name='do-reject', authenticate=False, permission=False)
+            def reject(self, request, *args, **kwargs):
+                return HttpResponse('rejected %s' % kwargs['pk'])
+
+        resource = FooResource()
+        urls = resource.prepend_urls()
+        self.assertEqual([url.name for url in urls], ['api_dispatch_command'])
+        self.assertEqual(len(resource._meta.extra_actions), 2)
+        for path, expected in (('foo/1/approve/', b'approved 1'), ('foo/2/do-reject/', b'rejected 2')):
+            match = urls[0].resolve(path)
+            response = match.func(RequestFactory().post('/'), *match.args, **match.kwargs)
+            self.assertEqual(response.content, expected)
+        self.assertIsNone(urls[0].resolve('foo/1/delete/'))
+        self.assertIsNone(urls[0].resolve('foo/1/2/approve/'))
+
+    def test_cqrs_batch(self):
+        # test @cqrsapi(batch=...) runs a command for many pks, authenticating once
+        import json
+        from django.test import RequestFactory
+        from tastypie.exceptions import BadRequest
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi
+
+        class FooResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                allowed_methods = ['post']
+
+            @cqrsapi(batch=True, permission=False)
+            def approve(self, request, *args, **kwargs):
+                return self.create_response(request, {'approved': kwargs['pk']})
+
+            @cqrsapi(batch='atomic', permission=False)
+            def rename(self, request, *args, **kwargs):
+                user = User.objects.get(pk=kwargs['pk'])
+                if user.username == 'bad':
+                    raise BadRequest('cannot rename')
+                user.first_name = 'renamed'
+                user.save()
+                return self.create_response(request, {'renamed': user.pk})
+
+        resource = FooResource()
+        urls = resource.prepend_urls()
+        self.assertEqual(urls[0].name, 'api_dispatch_command_batch')
+        match = urls[0].resolve('foo/approve/batch/')
+        request = RequestFactory().post('/', json.dumps({'pks': [1, 2, 3]}), content_type='application/json')
+        with patch.object(Authentication, 'is_authenticated', return_value=True) as is_authenticated:
+            response = match.func(request, *match.args, **match.kwargs)
+        self.assertEqual(is_authenticated.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual([item['data'] for item in data['objects']],
+                         [{'approved': 1}, {'approved': 2}, {'approved': 3}])
+        # -- atomic batches roll back if any command fails
+        good = User.objects.create(username='good')
+        bad = User.objects.create(username='bad')
+        match = urls[0].resolve('foo/rename/batch/')
+        request = RequestFactory().post('/?pks=%s,%s' % (good.pk, bad.pk))
+        response = match.func(request, *match.args, **match.kwargs)
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.content)
+        self.assertEqual([item['status'] for item in data['objects']], [200, 400])
+        self.assertEqual(data['objects'][1]['data'], {'error': 'cannot rename'})
+        good.refresh_from_db()
+        self.assertEqual(good.first_name, '')
+
+    def test_cqrs_run_async(self):
+        # test @cqrsapi(run_async=True) returns 202 and the result can be polled by its owner
+        import json
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory, override_settings
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi, command_jobs
+
+        class FooResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                allowed_methods = ['post']
+
+            @cqrsapi(run_async=True, authenticate=False, permission=False)
+            def report(self, request, *args, **kwargs):
+                return self.create_response(request, {'report': kwargs['pk']})
+
+        resource = FooResource()
+        urls = resource.prepend_urls()
+        self.assertEqual([url.name for url in urls], ['api_cqrs_job', 'api_dispatch_command_report'])
+        for settings_kwargs in ({}, {'TASTYPIE_CQRS_JOBS_CACHE': 'default'}):
+            with override_settings(**settings_kwargs):
+                request = RequestFactory().post('/')
+                request.user = AnonymousUser()
+                # -- jobs are submitted on commit
+                with self.captureOnCommitCallbacks() as callbacks:
+                    response = resource.wrap_view('report')(request, pk='7')
+                self.assertEqual(response.status_code, 202)
+                job_id = json.loads(response.content)['job']
+                poll = RequestFactory().get('/')
+                poll.user = AnonymousUser()
+                response = resource.wrap_view('dispatch_cqrs_job')(poll, job_id=job_id)
+                self.assertEqual(json.loads(response.content)['status'], 'pending')
+                for callback in callbacks:
+                    callback()
+                command_jobs.shutdown(wait=True)
+                response = resource.wrap_view('dispatch_cqrs_job')(poll, job_id=job_id)
+                data = json.loads(response.content)
+                self.assertEqual(data['status'], 'done')
+                self.assertEqual(data['result'], {'status': 200, 'data': {'report': '7'}})
+                # -- jobs of other users are not found
+                poll.user = User.objects.create(username='other{}'.format(len(settings_kwargs)))
+                response = resource.wrap_view('dispatch_cqrs_job')(poll, job_id=job_id)
+                self.assertEqual(response.status_code, 404)
+
+    def test_cqrs_idempotency_key(self):
+        # test commands replay the stored response for a repeated Idempotency-Key
+        from django.http import HttpResponse
+        from django.test import RequestFactory, override_settings
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi, command_responses
+
+        calls = []
+        retried = []
+
+        class FooResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                allowed_methods = ['get', 'post']
+
+            @cqrsapi(authenticate=False, permission=False, cache_ttl=60)
+            def approve(self, request, *args, **kwargs):
+                calls.append(kwargs['pk'])
+                if kwargs['pk'] == 'retry':
+                    # a retry while the first request is still running
+                    retried.append(view(post('/', HTTP_IDEMPOTENCY_KEY='retry'), pk='retry'))
+                return HttpResponse('approved %s' % len(calls))
+
+        command_responses.clear()
+        resource = FooResource()
+        view = resource.wrap_view('approve')
+        post = RequestFactory().post
+        for settings_kwargs in ({}, {'TASTYPIE_CQRS_RESPONSE_CACHE': 'default'}):
+            calls.clear()
+            with override_settings(**settings_kwargs):
+                response = view(post('/', HTTP_IDEMPOTENCY_KEY='abc'), pk='1')
+                replayed = view(post('/', HTTP_IDEMPOTENCY_KEY='abc'), pk='1')
+                self.assertEqual(replayed.content, response.content)
+                self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+                self.assertEqual(calls, ['1'])
+                # -- another key, pk or no key runs the command
+                view(post('/', HTTP_IDEMPOTENCY_KEY='xyz'), pk='1')
+                view(post('/', HTTP_IDEMPOTENCY_KEY='abc'), pk='2')
+                view(post('/'), pk='1')
+                view(post('/'), pk='1')
+                self.assertEqual(calls, ['1', '1', '2', '1', '1'])
+                # -- a key in flight is rejected, and stored once done
+                calls.clear()
+                retried.clear()
+                response = view(post('/', HTTP_IDEMPOTENCY_KEY='retry'), pk='retry')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([resp.status_code for resp in retried], [409])
+                replayed = view(post('/', HTTP_IDEMPOTENCY_KEY='retry'), pk='retry')
+                self.assertEqual(replayed.content, response.content)
+                self.assertEqual(calls, ['retry'])
+        # -- a reused key with a different body is rejected
+        calls.clear()
+        view(post('/', {'a': 1}, content_type='application/json', HTTP_IDEMPOTENCY_KEY='body'), pk='1')
+        response = view(post('/', {'a': 2}, content_type='application/json', HTTP_IDEMPOTENCY_KEY='body'), pk='1')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(calls, ['1'])
+        # -- GET responses are cached with cache_ttl, per format
+        calls.clear()
+        first = view(RequestFactory().get('/?a=1'), pk='1')
+        second = view(RequestFactory().get('/?a=1'), pk='1')
+        self.assertEqual(first.content, second.content)
+        self.assertNotIn('Idempotent-Replayed', second)
+        self.assertEqual(calls, ['1'])
+        view(RequestFactory().get('/?a=1', HTTP_ACCEPT='text/yaml'), pk='1')
+        self.assertEqual(calls, ['1', '1'])
+
+    def test_cqrs_pipeline_compiled(self):
+        # test the command pipeline is compiled once and skips the bundle for no-op authorization
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from tastypie.authorization import Authorization, ReadOnlyAuthorization
+        from tastypie.exceptions import Unauthorized
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi
+
+        class FooResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                allowed_methods = ['get', 'post']
+                authorization = Authorization()
+
+            @cqrsapi(authenticate=False)
+            def approve(self, request, *args, **kwargs):
+                return HttpResponse('approved')
+
+        resource = FooResource()
+        view = resource.wrap_view('approve')
+        with patch.object(FooResource, 'build_bundle') as build_bundle, \
+                patch.object(resource, 'compile_cqrs_pipeline',
+                             wraps=resource.compile_cqrs_pipeline) as compile_pipeline:
+            for i in range(3):
+                self.assertEqual(view(RequestFactory().post('/'), pk='1').content, b'approved')
+            build_bundle.assert_not_called()
+            self.assertEqual(compile_pipeline.call_count, 1)
+        # -- other authorizations are checked, with a bundle
+
+        class DenyCreateAuthorization(ReadOnlyAuthorization):
+            def create_list(self, object_list, bundle):
+                raise Unauthorized()
+
+        resource._meta.authorization = DenyCreateAuthorization()
+        resource.meta_changed()
+        self.assertEqual(view(RequestFactory().get('/'), pk='1').status_code, 200)
+        self.assertEqual(view(RequestFactory().post('/'), pk='1').status_code, 401)
+
+    def test_cqrs_metrics(self):
+        # test TASTYPIE_CQRS_METRICS records command phases and exports them
+        from django.test import RequestFactory, override_settings
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi
+        from tastypiex.metrics import registry, metrics_view
+
+        class FooResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                allowed_methods = ['post']
+
+            @cqrsapi(permission=False)
+            def approve(self, request, *args, **kwargs):
+                User.objects.count()
+                return self.create_response(request, {'approved': True})
+
+        registry.clear()
+        resource = FooResource()
+        with override_settings(TASTYPIE_CQRS_METRICS=True):
+            for i in range(2):
+                response = resource.wrap_view('approve')(RequestFactory().post('/'), pk='1')
+                self.assertEqual(response.status_code, 200)
+        labels = dict(resource='foo', command='approve')
+        self.assertEqual(registry.histogram('tastypie_cqrs_command_seconds', **labels).count, 2)
+        for phase in ('authentication', 'throttle', 'handler', 'serialization'):
+            self.assertEqual(registry.histogram('tastypie_cqrs_phase_seconds', phase=phase, **labels).count, 2)
+        self.assertEqual(registry.histogram('tastypie_cqrs_queries', **labels).sum, 2)
+        # -- export in prometheus format, for staff or in DEBUG only
+        request = RequestFactory().get('/')
+        request.user = User(is_staff=False)
+        self.assertEqual(metrics_view(request).status_code, 404)
+        request.user.is_staff = True
+        text = metrics_view(request).content.decode()
+        self.assertIn('# TYPE tastypie_cqrs_command_seconds histogram', text)
+        self.assertIn('tastypie_cqrs_queries_count{command="approve",resource="foo"} 2', text)
+        self.assertIn('tastypie_cqrs_phase_seconds_bucket{command="approve",phase="handler",'
+                      'resource="foo",le="+Inf"} 2', text)
+        # -- ApiCentralizer mounts the endpoint
+        centralizer = ApiCentralizer(apis=[Api('v1')], autoinit=False, swaggerui=False,
+                                     redocui=False, metrics=True)
+        self.assertEqual(centralizer.get_urls(r'^api/')[-1].name, 'tastypiex_metrics')
+
+    def test_add_resource_mixins_memoized(self):
+        # test mixin classes are composed once, not re-applied and not kept alive
+        import gc
+        from tastypiex.modresource import add_class_mixins, add_resource_mixins, mixin_class
+
+        class FooMixin(object):
+            def __init__(self, *args, **kwargs):
+                self.foo_inits = getattr(self, 'foo_inits', 0) + 1
+
+        class FooResource(Resource):
+            class Meta:
+                resource_name = 'foo'
+
+        first, second = FooResource(), FooResource()
+        add_resource_mixins(first, FooMixin)
+        add_resource_mixins(second, FooMixin)
+        self.assertIs(first.__class__, second.__class__)
+        self.assertEqual(first.__class__.__name__, 'FooResource')
+        self.assertIs(add_class_mixins(FooResource, FooMixin), first.__class__)
+        # -- re-applying a mixin is a no-op
+        composed = first.__class__
+        add_resource_mixins(first, FooMixin)
+        self.assertIs(first.__class__, composed)
+        self.assertEqual(first.foo_inits, 1)
+        self.assertIs(mixin_class(composed, FooMixin), composed)
+        # -- unused composed classes are garbage collected
+        ref = weakref.ref(composed)
+        del first, second, composed
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_cqrs_batch_savepoints_and_hooks(self):
+        # test batch items roll back their savepoint on errors and call the dispatch hooks
+        import json
+        from django.test import RequestFactory
+        from tastypie.exceptions import BadRequest
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi
+
+        hooks = []
+
+        class FooResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                allowed_methods = ['post']
+
+            def pre_cqrs_dispatch(self, request, *args, **kwargs):
+                hooks.append(('pre', kwargs['pk']))
+
+            def post_cqrs_dispatch(self, response, *args, **kwargs):
+                hooks.append(('post', kwargs['pk']))
+
+            @cqrsapi(batch='atomic', permission=False, authenticate=False)
+            def create(self, request, *args, **kwargs):
+                if kwargs['pk'] == 'fail':
+                    User.objects.create(username='partial')
+                    raise BadRequest('failed')
+                return self.create_response(request, {'partial': User.objects.filter(username='partial').exists()})
+
+        resource = FooResource()
+        request = RequestFactory().post('/?pks=fail,check')
+        response = resource.dispatch_cqrs_batch(request, resource_name='foo', command='create')
+        data = json.loads(response.content)
+        self.assertEqual([item['status'] for item in data['objects']], [400, 200])
+        # -- the failed item's savepoint was rolled back before the next item ran
+        self.assertEqual(data['objects'][1]['data'], {'partial': False})
+        self.assertEqual(hooks, [('pre', 'fail'), ('pre', 'check'), ('post', 'check')])
+
+    def test_cqrs_batch_authorized_per_item(self):
+        # test batch commands authorize every pk by its detail path
+        import json
+        from django.test import RequestFactory
+        from tastypie.exceptions import Unauthorized
+        from tastypiex.cqrsmixin import CQRSApiMixin, cqrsapi
+
+        paths = []
+
+        class FooResource(CQRSApiMixin, Resource):
+            class Meta:
+                resource_name = 'foo'
+                allowed_methods = ['post']
+
+            def is_authorized(self, action, object_list, bundle):
+                paths.append(object_list[0])
+                if '/2/' in object_list[0]:
+                    raise Unauthorized()
+
+            @cqrsapi(batch=True, authenticate=False)
+            def approve(self, request, *args, **kwargs):
+                return self.create_response(request, {'approved': kwargs['pk']})
+
+            @cqrsapi(batch='atomic', authenticate=False)
+            def rename(self, request, *args, **kwargs):
+                User.objects.create(username='renamed{}'.format(kwargs['pk']))
+                return self.create_response(request, {'renamed': kwargs['pk']})
+
+        resource = FooResource()
+        response = resource.wrap_view('approve')(RequestFactory().post('/api/foo/2/approve/'), pk='2')
+        self.assertEqual(response.status_code, 401)
+        request = RequestFactory().post('/api/foo/approve/batch/?pks=1,2')
+        response = resource.dispatch_cqrs_batch(request, resource_name='foo', command='approve')
+        data = json.loads(response.content)
+        self.assertEqual([item['status'] for item in data['objects']], [200, 401])
+        self.assertEqual(paths[-2:], ['/api/foo/1/approve/', '/api/foo/2/approve/'])
+        # -- atomic batches fail as a whole
+        request = RequestFactory().post('/api/foo/rename/batch/?pks=1,2')
+        response = resource.dispatch_cqrs_batch(request, resource_name='foo', command='rename')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.filter(username__startswith='renamed').exists())
@@ -1,8 +1,11 @@
+from collections import OrderedDict
 from importlib import import_module
 
 import functools
 import importlib
 import sys
+import threading
+import time
 from datetime import timedelta
 
 
@@ -89,3 +92,77 @@ def seconds(duration=None, **specs):
     else:
         duration = 0
     return duration
+
+
+class ExpiringLRUCache(object):
+    """
+    A bounded, thread-safe LRU cache with per-entry expiry
+
+    Usage:
+        cache = ExpiringLRUCache(maxsize=1024)
+        cache.set(key, value, expires=time.time() + 60)
+        cache.get(key) # => value, or default if missing or expired
+
+    Notes:
+        - expires is an absolute timestamp as returned by clock(), None
+          means the entry does not expire
+        - once maxsize is reached, the least recently used entry is dropped
+    """
+
+    def __init__(self, maxsize=1024, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= self.clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires=None):
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, expires=None):
+        """ set key only if it is missing or expired, return True if it was set """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > self.clock()):
+                return False
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value, expires = self._data.pop(key, (default, None))
+            return value
+
+    def discard(self, predicate):
+        """ drop all entries whose value matches predicate(value) """
+        with self._lock:
+            for key in [key for key, (value, expires) in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self